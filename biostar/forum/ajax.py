@@ -15,13 +15,14 @@ from django.conf import settings
 from django.db.models import Q, Count
 from django.shortcuts import reverse, redirect
 from django.template import loader
+from django.utils.html import escape
 from django.http import JsonResponse
 from django.views.decorators.csrf import ensure_csrf_cookie
 from whoosh.searching import Results
 
 from biostar.accounts.models import Profile, User
-from . import auth, util, forms, tasks, search, views, const, moderate
-from .models import Post, Vote, Subscription, delete_post_cache, SharedLink, Diff
+from . import auth, util, forms, tasks, search, views, const, moderate, autocomplete
+from .models import Post, Vote, Subscription, delete_post_cache, SharedLink, Diff, Similar
 
 
 
@@ -399,6 +400,23 @@ def handle_search(request):
     return ajax_success(users=users, msg="Username searched")
 
 
+@ajax_error_wrapper(method="GET", login_required=False)
+def search_autocomplete(request):
+    """
+    Suggests post titles and tags starting with the query, answered from memory.
+    """
+    query = request.GET.get('query', '')
+    found = autocomplete.suggest(query, limit=settings.AUTOCOMPLETE_LIMIT)
+
+    # The search bar inserts the labels as html.
+    for post in found['posts']:
+        post.update(url=reverse('post_view', kwargs=dict(uid=post['uid'])), label=escape(post['label']))
+    for tag in found['tags']:
+        tag.update(url=reverse('post_tags', kwargs=dict(tag=tag['label'])), label=escape(tag['label']))
+
+    return ajax_success(msg="Suggestions", **found)
+
+
 @ajax_limited(key=RATELIMIT_KEY, rate=EDIT_RATE)
 @ajax_error_wrapper(method="GET")
 def inplace_form(request):
@@ -495,8 +513,16 @@ def similar_posts(request, uid):
 
     if results is None:
         logger.debug("Setting similar posts cache.")
-        # Do a more like this search on post
-        similar = search.more_like_this(uid=post.uid)
+        computed = Similar.objects.filter(post=post).first()
+        if computed:
+            # Use the similar posts computed offline, most similar first.
+            uids = computed.uid_list
+            found = Post.objects.valid_posts(uid__in=uids).select_related('author__profile')
+            order = {uid: index for index, uid in enumerate(uids)}
+            similar = sorted(found, key=lambda p: order[p.uid])
+        else:
+            # Do a more like this search on post
+            similar = search.more_like_this(uid=post.uid)
         # Render template with posts
         tmpl = loader.get_template(template_name)
         context = dict(results=similar)
@@ -1,4 +1,5 @@
 
+import hashlib
 import json
 import os
 import logging
@@ -8,6 +9,8 @@ from django.conf import settings
 from datetime import datetime, timedelta
 
 from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django.views.decorators.csrf import csrf_exempt
 from biostar.accounts.models import Profile, User
 from . import util
@@ -123,7 +126,12 @@ def json_response(f):
         if not data:
             response.status_code = 404
             response.reason_phrase = 'Not found'
-        return response
+            return response
+
+        # Clients holding the same payload get an empty 304 response.
+        etag = quote_etag(hashlib.md5(payload.encode()).hexdigest())
+        response['ETag'] = etag
+        return get_conditional_response(request, etag=etag, response=response)
     return to_json
 
 
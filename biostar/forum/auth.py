@@ -9,7 +9,7 @@ from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
 from django.db import transaction
-from django.db.models import F, Q
+from django.db.models import F, Q, Count
 from django.template import loader
 from django.utils.safestring import mark_safe
 from django.conf import settings
@@ -22,7 +22,8 @@ from biostar.accounts.models import Profile
 from biostar.utils.helpers import get_ip
 from . import util, awards
 from .const import *
-from .models import Post, Vote, Subscription, Badge, delete_post_cache, Log, SharedLink, Diff
+from .models import Post, Vote, Subscription, Badge, delete_post_cache, thread_version, bump_thread, Log, SharedLink, \
+    Diff
 
 User = get_user_model()
 
@@ -141,24 +142,38 @@ def gravatar(user, size=80):
     return gravatar_url(email=email, style=style, size=size)
 
 
-def walk_down_thread(parent, collect=set()):
+def make_graph(pairs):
     """
-    Recursively walk down a thread of posts starting from target
+    Returns the children of each node, keyed by parent, from (child, parent) pairs.
     """
+    graph = dict()
+    for child, parent in pairs:
+        graph.setdefault(parent, []).append(child)
+    return graph
 
-    # Stop condition: post does not have a root or parent.
-    if (parent is None) or (parent.parent is None) or (parent.root is None):
-        return collect
 
-    # Get all children for this post, excluding itself.
-    children = Post.objects.filter(parent=parent).exclude(uid=parent.uid)
+def thread_graph(root):
+    """
+    Returns the ids of the direct replies to each post of a thread, keyed by parent id.
+
+    A single query fetches the (id, parent_id) pairs of the whole thread.
+    """
+    pairs = Post.objects.filter(root_id=root.id).exclude(id=F('parent_id')).values_list('id', 'parent_id')
+    return make_graph(pairs)
 
-    for child in children:
-        # Add child to list
-        collect.add(child)
-        # Get all children belonging to the current child.
-        walk_down_thread(parent=child, collect=collect)
 
+def descendants(graph, start):
+    """
+    Returns every node below start in the graph, walked in memory.
+    """
+    collect = set()
+    stack = list(graph.get(start, []))
+    while stack:
+        node = stack.pop()
+        if node in collect:
+            continue
+        collect.add(node)
+        stack.extend(graph.get(node, []))
     return collect
 
 
@@ -342,6 +357,34 @@ def create_subscription(post, user, sub_type=None, update=False):
     delete_cache(FOLLOWING, user)
 
 
+def create_subscriptions(post, users):
+    """
+    Subscribes users to the thread of a post with one insert, existing subscriptions are kept.
+    """
+    root = post.root
+    users = {user.pk: user for user in users}
+    if not (root and users):
+        return
+
+    subscribed = set(Subscription.objects.filter(post=root, user_id__in=users).values_list('user_id', flat=True))
+    added = [user for pk, user in users.items() if pk not in subscribed]
+    if not added:
+        return
+
+    date = util.now()
+    subs = [Subscription(post=root, user=user, date=date,
+                         type=Subscription.TYPE_MAP.get(user.profile.message_prefs, Subscription.LOCAL_MESSAGE))
+            for user in added]
+    Subscription.objects.bulk_create(subs, ignore_conflicts=True)
+
+    # Recompute subscription count
+    subs_count = Subscription.objects.filter(post=root).exclude(type=Subscription.NO_MESSAGES).count()
+    Post.objects.filter(pk=root.pk).update(subs_count=subs_count)
+
+    for user in added:
+        delete_cache(FOLLOWING, user)
+
+
 def is_suspended(user):
     if user.is_authenticated and user.profile.state in (Profile.BANNED, Profile.SUSPENDED, Profile.SPAMMER):
         return True
@@ -349,24 +392,75 @@ def is_suspended(user):
     return False
 
 
-def post_tree(user, root):
+def thread_ids(user, root):
     """
-    Populates a tree that contains all posts in the thread.
+    Returns the sorted ids of the posts in a thread and its comment tree, cached until the thread changes.
 
-    Answers sorted before comments.
+    The comment tree maps a parent id to the ids of its comments.
+    Moderators and everyone else see different posts and get separate copies.
     """
 
+    moderator = user.is_authenticated and user.profile.is_moderator
+    version = thread_version(root.uid)
+    cache_key = f"{THREAD_CACHE_KEY}-{root.uid}-{version}-{int(moderator)}"
+
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     # Get all posts that belong to post root.
     query = Post.objects.valid_posts(u=user, root=root).exclude(pk=root.id)
 
     # Filter spam/deleted comments or answers.
-    if user.is_anonymous or not user.profile.is_moderator:
+    if not moderator:
         query = query.exclude(Q(status=Post.DELETED) | Q(spam=Post.SPAM))
 
-    query = query.select_related("lastedit_user__profile", "author__profile", "root__author__profile")
-
     # Apply the sort order to all posts in thread.
-    thread = query.order_by("type", "-accept_count", "-vote_count", "creation_date")
+    query = query.order_by("type", "-accept_count", "-vote_count", "creation_date")
+    rows = list(query.values_list("id", "parent_id", "type"))
+
+    ids = [pk for pk, parent_id, ptype in rows]
+    tree = make_graph((pk, parent_id) for pk, parent_id, ptype in rows if ptype == Post.COMMENT)
+
+    cache.set(cache_key, (ids, tree), settings.THREAD_CACHE_TIMEOUT)
+
+    return ids, tree
+
+
+def thread_posts(user, root):
+    """
+    Returns the sorted posts of a thread and its comment tree of posts.
+
+    Only the ids are cached, the posts are loaded with a single query and share the given root.
+    """
+    ids, tree = thread_ids(user=user, root=root)
+
+    posts = Post.objects.select_related("lastedit_user__profile", "author__profile")
+
+    # Posts hidden since the ids were cached are not shown.
+    if not (user.is_authenticated and user.profile.is_moderator):
+        posts = posts.filter(visible=True)
+
+    posts = posts.in_bulk(ids)
+    for post in posts.values():
+        post.root = root
+
+    # Posts removed or hidden since the ids were cached are skipped.
+    thread = [posts[pk] for pk in ids if pk in posts]
+    tree = {parent_id: [posts[pk] for pk in children if pk in posts] for parent_id, children in tree.items()}
+
+    return thread, tree
+
+
+def post_tree(user, root):
+    """
+    Populates a tree that contains all posts in the thread.
+
+    Answers sorted before comments.
+    """
+
+    # The posts are shared by all users, only the decorations below are per user.
+    thread, tree = thread_posts(user=user, root=root)
 
     # Gather votes by the current user.
     votes = get_votes(user=user, root=root)
@@ -374,13 +468,8 @@ def post_tree(user, root):
     # Shortcuts to each storage.
     bookmarks, upvotes = votes[Vote.BOOKMARK], votes[Vote.UP]
 
-    # Build comments tree.
-    comment_tree = dict()
-
     def decorate(post):
         # Mutates the elements! Not worth creating copies.
-        if post.is_comment:
-            comment_tree.setdefault(post.parent_id, []).append(post)
         post.has_bookmark = int(post.id in bookmarks)
         post.has_upvote = int(post.id in upvotes)
         if user.is_authenticated:
@@ -397,6 +486,9 @@ def post_tree(user, root):
     # Decorate the objects for easier access
     thread = list(map(decorate, thread))
 
+    # Comments tree keyed by parent id.
+    comment_tree = tree
+
     # Decorate the root post
     root = decorate(root)
 
@@ -469,28 +561,37 @@ def apply_vote(post, user, vote_type):
     if not post.author == user:
         Profile.objects.filter(user=post.author).update(score=F('score') + change)
 
-    # Calculate counts for the current post
-    votes = list(Vote.objects.filter(post=post))
-    vote_count = len(votes)
-    bookcount = len(list(filter(lambda v: v.type == Vote.BOOKMARK, votes)))
-    accept_count = len(list(filter(lambda v: v.type == Vote.ACCEPT, votes)))
+    # Calculate counts for the current post in one query.
+    counts = Vote.objects.filter(post=post).aggregate(vote_count=Count('id'),
+                                                      book_count=Count('id', filter=Q(type=Vote.BOOKMARK)),
+                                                      accept_count=Count('id', filter=Q(type=Vote.ACCEPT)))
 
-    # Increment the post vote count.
-    Post.objects.filter(uid=post.uid).update(vote_count=vote_count)
+    # Only the counts of the vote type that changed are written.
+    fields = dict(vote_count=counts['vote_count'])
+    if vote_type == Vote.BOOKMARK:
+        fields.update(book_count=counts['book_count'])
+    if vote_type == Vote.ACCEPT:
+        fields.update(accept_count=counts['accept_count'])
 
     # The thread vote count represents all votes in a thread
-    Post.objects.filter(uid=post.root.uid).update(thread_votecount=F('thread_votecount') + change)
+    thread = dict(thread_votecount=F('thread_votecount') + change)
+    if vote_type == Vote.ACCEPT:
+        thread.update(accept_count=F('accept_count') + change)
+
+    # One update per affected row, a top level post is its own root.
+    if post.root_id == post.id:
+        fields.update(thread)
+        Post.objects.filter(pk=post.pk).update(**fields)
+    else:
+        Post.objects.filter(pk=post.pk).update(**fields)
+        Post.objects.filter(pk=post.root_id).update(**thread)
 
-    # Increment the bookmark count.
+    # Reset bookmark cache
     if vote_type == Vote.BOOKMARK:
-        Post.objects.filter(uid=post.uid).update(book_count=bookcount)
-        # Reset bookmark cache
         delete_cache(BOOKMARKS, user)
 
-    # Handle accepted vote.
-    if vote_type == Vote.ACCEPT:
-        Post.objects.filter(uid=post.uid).update(accept_count=accept_count)
-        Post.objects.filter(uid=post.root.uid).update(accept_count=F('accept_count') + change)
+    # The cached thread and listings show the vote counts.
+    bump_thread(post)
 
     return msg, vote, change
 
@@ -502,17 +603,22 @@ def move(request, parent, source, ptype=Post.COMMENT, msg="moved"):
     if source.is_toplevel or not parent:
         return url
 
-    # Move this post to comment of parent
-    source.parent = parent
-    source.type = ptype
+    with transaction.atomic():
+        # Take the post out of the counts of its current parent.
+        source.update_parent_counts(delta=-1)
+
+        # Move this post to comment of parent
+        source.parent = parent
+        source.type = ptype
+
+        title = f"{source.get_type_display()}: {source.root.title[:80]}"
+        Post.objects.filter(uid=source.uid).update(parent=parent, type=ptype, title=title)
 
-    title = f"{source.get_type_display()}: {source.root.title[:80]}"
-    Post.objects.filter(uid=source.uid).update(parent=parent, type=ptype, title=title)
+        source.update_parent_counts(delta=1)
 
     # Log action and let user know
     messages.info(request, mark_safe(msg))
     db_logger(user=user, text=f"{msg}", post=source)
-    source.update_parent_counts()
     return url
 
 
@@ -562,13 +668,8 @@ def validate_move(user, source, target):
     is_diff = source.uid != target.uid
 
     # cond 4: target is not a descendant of source.
-    children = set()
-    try:
-        walk_down_thread(parent=source, collect=children)
-        not_desc = (target not in children)
-    except Exception as exc:
-        logger.error(exc)
-        not_desc = False
+    children = descendants(graph=thread_graph(source.root), start=source.id)
+    not_desc = target.id not in children
 
     # cond 5: source is not top level
     not_toplevel = not source.is_toplevel
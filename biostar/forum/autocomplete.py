@@ -0,0 +1,229 @@
+"""
+Type-ahead suggestions for the search bar.
+
+Post titles and tag names are kept in sorted prefix arrays searched with bisect.
+The indexer maintains the arrays and saves a snapshot next to the search index,
+web processes load the snapshot and answer from memory.
+"""
+import logging
+import os
+import pickle
+import threading
+import time
+from bisect import bisect_left, insort
+from heapq import nlargest
+
+from django.conf import settings
+from django.db.models import Count, Q
+from taggit.models import Tag
+
+from biostar.forum.models import Post
+
+logger = logging.getLogger('engine')
+
+# Words of a title that start a key, longer titles only match on their first words.
+MAX_WORDS = 10
+
+# Characters kept of each key.
+MAX_KEY = 60
+
+
+def normalize(text):
+    return ' '.join(text.lower().split())[:MAX_KEY]
+
+
+class PrefixIndex:
+    """
+    Sorted (key, ident) pairs searched by prefix, each ident points to a weighted label.
+
+    A label is reachable from the start of each of its words.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def make_keys(self, label):
+        words = label.lower().split()[:MAX_WORDS]
+        return {normalize(' '.join(words[start:])) for start in range(len(words))}
+
+    def add(self, ident, label, weight, **extra):
+        self.remove(ident)
+        label = label.strip()
+        keys = self.make_keys(label)
+        for key in keys:
+            insort(self.keys, (key, ident))
+        self.entries[ident] = (weight, label, keys, extra)
+
+    def extend(self, items):
+        """
+        Adds (ident, label, weight, extra) entries in bulk, the keys are sorted once at the end.
+        """
+        added = []
+        for ident, label, weight, extra in items:
+            self.remove(ident)
+            label = label.strip()
+            keys = self.make_keys(label)
+            added.extend((key, ident) for key in keys)
+            self.entries[ident] = (weight, label, keys, extra)
+
+        self.keys.extend(added)
+        self.keys.sort()
+
+    def remove(self, ident):
+        entry = self.entries.pop(ident, None)
+        if not entry:
+            return
+        for key in entry[2]:
+            index = bisect_left(self.keys, (key, ident))
+            if index < len(self.keys) and self.keys[index] == (key, ident):
+                del self.keys[index]
+
+    def search(self, prefix, limit=10, scan=500):
+        """
+        Returns up to limit entries of the highest weight among the first scan keys starting with prefix.
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        found = set()
+        index = bisect_left(self.keys, (prefix,))
+        end = min(len(self.keys), index + scan)
+        while index < end and self.keys[index][0].startswith(prefix):
+            found.add(self.keys[index][1])
+            index += 1
+
+        best = nlargest(limit, found, key=lambda ident: self.entries[ident][0])
+        return [dict(label=self.entries[ident][1], **self.entries[ident][3]) for ident in best]
+
+
+class Completions:
+    """
+    Prefix indexes of post titles weighted by rank and of tags weighted by usage.
+    """
+
+    def __init__(self):
+        self.posts = PrefixIndex()
+        self.tags = PrefixIndex()
+
+    def update_posts(self, ids):
+        """
+        Applies the current state of the posts with the given ids.
+        """
+        posts = Post.objects.filter(id__in=ids).only('id', 'uid', 'title', 'rank', 'is_toplevel', 'status', 'spam')
+        seen = set()
+        for post in posts:
+            seen.add(post.id)
+            if post.is_toplevel and post.is_open:
+                self.posts.add(post.id, post.title, post.rank, uid=post.uid)
+            else:
+                self.posts.remove(post.id)
+
+        # Deleted posts.
+        for ident in set(ids) - seen:
+            self.posts.remove(ident)
+
+    def update_tags(self):
+        """
+        Tag usage changes with every post, the tags are small enough to recount.
+        """
+        count = Count('post', filter=Q(post__is_toplevel=True))
+        tags = Tag.objects.annotate(nitems=count).filter(nitems__gt=0).values_list('id', 'name', 'nitems')
+
+        self.tags = PrefixIndex()
+        self.tags.extend((ident, name, nitems, dict(count=nitems)) for ident, name, nitems in tags)
+
+    def suggest(self, query, limit=10):
+        return dict(posts=self.posts.search(query, limit=limit), tags=self.tags.search(query, limit=limit))
+
+
+def snapshot_path():
+    return os.path.join(settings.INDEX_DIR, f"{settings.INDEX_NAME}-completions.pickle")
+
+
+def build():
+    """
+    Builds the completions of every valid top level post and tag.
+    """
+    completions = Completions()
+    posts = Post.objects.valid_posts(is_toplevel=True).values_list('id', 'uid', 'title', 'rank')
+    completions.posts.extend((ident, title, rank, dict(uid=uid)) for ident, uid, title, rank in posts.iterator())
+
+    completions.update_tags()
+    return completions
+
+
+def save(completions):
+    """
+    Atomically replaces the snapshot read by the web processes.
+    """
+    fname = snapshot_path()
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp = f"{fname}.tmp"
+    with open(tmp, 'wb') as fp:
+        pickle.dump(completions, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, fname)
+
+
+def load():
+    """
+    Returns the saved completions, built from the database when there is no snapshot yet.
+    """
+    fname = snapshot_path()
+    if not os.path.exists(fname):
+        return build()
+    with open(fname, 'rb') as fp:
+        return pickle.load(fp)
+
+
+def update(ids, completions=None):
+    """
+    Applies changed posts to the completions and saves them, used by the indexer.
+    """
+    completions = completions or load()
+    completions.update_posts(ids)
+    completions.update_tags()
+    save(completions)
+    return completions
+
+
+class Snapshot:
+    """
+    The completions of this process, reloaded when the indexer saves a new snapshot.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.completions = Completions()
+        self.mtime = None
+        self.checked = 0
+
+    def get(self):
+        now = time.time()
+        if now - self.checked < settings.AUTOCOMPLETE_RELOAD:
+            return self.completions
+
+        with self.lock:
+            self.checked = now
+            try:
+                mtime = os.stat(snapshot_path()).st_mtime
+            except OSError:
+                return self.completions
+
+            if mtime != self.mtime:
+                self.completions = load()
+                self.mtime = mtime
+
+        return self.completions
+
+
+# One snapshot per process.
+SNAPSHOT = Snapshot()
+
+
+def suggest(query, limit=10):
+    return SNAPSHOT.get().suggest(query, limit=limit)
@@ -0,0 +1,46 @@
+"""
+Helpers shared by the benchmark commands: the synthetic vocabulary, latency statistics and the JSON report.
+"""
+import json
+import logging
+import statistics
+
+logger = logging.getLogger('engine')
+
+# Package names, also used as tags in the synthetic corpus.
+PACKAGES = ['samtools', 'bwa', 'bowtie2', 'deseq2', 'edger', 'gatk', 'bedtools', 'picard', 'star', 'hisat2',
+            'salmon', 'kallisto', 'trimmomatic', 'fastqc', 'multiqc', 'bcftools', 'limma', 'seurat', 'macs2', 'blast']
+
+# Filler words of the synthetic posts.
+WORDS = ('the a of in to with using from file data reads genome sample output input run error version '
+         'install analysis sequence alignment reference annotation table plot result script how why').split()
+
+
+def percentiles(values):
+    """
+    Returns latency statistics in milliseconds using nearest rank percentiles.
+    """
+    if not values:
+        return dict(count=0)
+
+    values = sorted(values)
+
+    def rank(p):
+        return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 3)
+
+    return dict(count=len(values), mean=round(statistics.mean(values) * 1000, 3),
+                p50=rank(50), p95=rank(95), p99=rank(99), max=round(values[-1] * 1000, 3))
+
+
+def write_report(report, output=''):
+    """
+    Writes the report as JSON to the output file, or prints it.
+    """
+    text = json.dumps(report, indent=4)
+
+    if output:
+        with open(output, 'wt') as fp:
+            fp.write(text)
+        logger.info(f"Wrote report to {output}")
+    else:
+        print(text)
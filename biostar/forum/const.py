@@ -25,13 +25,19 @@ ORDER_MAPPER = {
 
 }
 
-ALLOWED_PARAMS = {"page", "order", "type", "limit", "query", "user", "active"}
+ALLOWED_PARAMS = {"page", "cursor", "order", "type", "limit", "query", "user", "active"}
 
 # Cache keys used to cache objects.
 LATEST_CACHE_KEY = "LATEST"
 TAGS_CACHE_KEY = "TAGS"
 SIMILAR_CACHE_KEY = "similar"
 USERS_LIST_KEY = "USERS_LIST"
+THREAD_CACHE_KEY = "THREAD"
+THREAD_VERSION_KEY = "THREAD_VERSION"
+USER_POSTS_KEY = "USER_POSTS"
+PAGE_CACHE_KEY = "PAGE"
+LISTING_VERSION_KEY = "LISTING_VERSION"
+THREAD_STATE_KEY = "THREAD_STATE"
 
 # The name of the session count data.
 COUNT_DATA_KEY = "COUNT_DATA"
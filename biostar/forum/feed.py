@@ -1,5 +1,8 @@
+import hashlib
+
 from django.contrib.syndication.views import Feed
 from django.shortcuts import render
+from django.views.decorators.http import condition
 
 from biostar.forum.models import Post
 from biostar.forum.util import now, split
@@ -18,6 +21,15 @@ FEED_COUNT = 25
 HTML_THRESHOLD = 1500
 
 
+def feed_posts(posts):
+    """
+    Selects the columns of the feed items.
+    """
+    posts = posts.select_related("root")
+    return posts.only("uid", "title", "content", "creation_date", "lastedit_date", "is_toplevel", "root",
+                      "root__uid")
+
+
 def reduce_html(text):
     if len(text) > HTML_THRESHOLD:
         text = bleach.clean(text, strip=True)
@@ -31,6 +43,30 @@ class PostBase(Feed):
     title = "title"
     description = "description"
 
+    def posts(self, obj):
+        """
+        Returns the posts of the feed, most recent first.
+        """
+        return Post.objects.none()
+
+    def items(self, obj):
+        return feed_posts(self.posts(obj))[:FEED_COUNT]
+
+    def __call__(self, request, *args, **kwargs):
+        """
+        Answers with 304 Not Modified when the posts in the feed and their edit dates are the same.
+        """
+        obj = self.get_object(request, *args, **kwargs)
+        rows = list(self.posts(obj).values_list('id', 'lastedit_date')[:FEED_COUNT])
+
+        etag = hashlib.md5(repr(rows).encode()).hexdigest()
+        modified = max((date for pid, date in rows), default=None)
+
+        view = condition(etag_func=lambda *args, **kwargs: etag,
+                         last_modified_func=lambda *args, **kwargs: modified)(super().__call__)
+
+        return view(request, *args, **kwargs)
+
     def item_title(self, item):
         return item.title
 
@@ -43,17 +79,20 @@ class PostBase(Feed):
     def item_pubdate(self, item):
         return item.creation_date
 
+    def item_updateddate(self, item):
+        return item.lastedit_date
+
 
 class LatestFeed(PostBase):
     "Latest posts"
     title = f"{SITE_NAME} latest!"
     description = f"Latest 25 posts from the {title}"
 
-    def items(self):
+    def posts(self, obj):
         # Delay posts hours.
         delay_time = now() - timedelta(hours=2)
         posts = Post.objects.valid_posts(creation_date__lt=delay_time).exclude(type=Post.BLOG).order_by('-creation_date')
-        return posts[:FEED_COUNT]
+        return posts
 
 
 class PostTypeFeed(PostBase):
@@ -74,10 +113,10 @@ class PostTypeFeed(PostBase):
     def title(self, obj):
         return "Post Activity"
 
-    def items(self, obj):
+    def posts(self, obj):
         codes, text = obj
         posts = Post.objects.valid_posts(type__in=codes).order_by('-creation_date')
-        return posts[:FEED_COUNT]
+        return posts
 
 
 class PostFeed(PostBase):
@@ -91,10 +130,10 @@ class PostFeed(PostBase):
     def title(self, obj):
         return "Post Activity"
 
-    def items(self, text):
+    def posts(self, text):
         ids = split(text)
         posts = Post.objects.valid_posts(root__uid__in=ids).order_by('-creation_date')
-        return posts[:FEED_COUNT]
+        return posts
 
 
 class TagFeed(PostBase):
@@ -110,9 +149,9 @@ class TagFeed(PostBase):
     def title(self, obj):
         return "Post Feed"
 
-    def items(self, obj):
+    def posts(self, obj):
         posts = Post.objects.valid_posts(tags__name__in=obj)
-        return posts[:FEED_COUNT]
+        return posts
 
 
 class UserFeed(PostBase):
@@ -126,7 +165,7 @@ class UserFeed(PostBase):
     def title(self, obj):
         return "User Feed"
 
-    def items(self, text):
+    def posts(self, text):
         ids = split(text)
         posts = Post.objects.valid_posts(author__profile__uid__in=ids).order_by('-creation_date')
-        return posts[:FEED_COUNT]
+        return posts
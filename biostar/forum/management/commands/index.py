@@ -1,11 +1,14 @@
 
 import logging
+import signal
+import time
 from typing import Any
 import os, sys
+from whoosh.index import LockError
 from django.core.management.base import BaseCommand
 from biostar.forum.models import Post
 from django.conf import settings
-from biostar.forum import search
+from biostar.forum import search, autocomplete
 from biostar.utils.decorators import check_lock
 
 logger = logging.getLogger('engine')
@@ -20,7 +23,8 @@ def build(size, remove=False):
     """
 
     # Get top level posts that have not been indexed.
-    posts = Post.objects.valid_posts(indexed=False, is_toplevel=True).exclude(root=None)[:size]
+    posts = Post.objects.valid_posts(indexed=False, is_toplevel=True).exclude(root=None)
+    posts = posts.select_related('author__profile')[:size]
     target_count = len(posts)
 
     # The list of posts to update
@@ -38,17 +42,81 @@ def build(size, remove=False):
 
     # Take spam posts that have been indexed and remove.
     spam_posts = Post.objects.filter(spam=Post.SPAM, indexed=False)[:size]
-    sids = [post.id for post in spam_posts]
+    uids = [post.uid for post in spam_posts]
 
-    for post in spam_posts:
-        # Remove spam from search index.
-        search.remove_post(post=post)
+    # Remove spam and deleted posts from search index in one commit, this also sets the indexed flag.
+    with search.queued_deletes() as deleted:
+        search.update_index(delete=uids + deleted)
 
-    # Update the spam indexed flag.
-    Post.objects.filter(id__in=sids).update(indexed=True)
+    logger.info(f"Removed {len(uids)} spam posts from index")
 
-    # Add to spam index
-    logger.info(f"Removed {len(sids)} spam posts from index")
+    # Bring the search bar suggestions up to date.
+    autocomplete.update(ids + [post.id for post in spam_posts])
+
+
+@check_lock(LOCK)
+def rebuild(procs, size):
+    """
+    Rebuilds the search index from scratch using multiple processes.
+    """
+    search.parallel_index(procs=procs, size=size)
+    autocomplete.save(autocomplete.build())
+
+
+@check_lock(LOCK)
+def watch(size, interval=5):
+    """
+    Keeps the search index in sync with the database until interrupted.
+
+    Each batch of up to size posts, along with the queued deletes, is written and committed
+    with its own writer, so the index lock is only held while a batch is written.
+    """
+
+    ix = search.init_index()
+
+    # Search bar suggestions are updated along with the index.
+    completions = autocomplete.load()
+
+    # Shut down cleanly when stopped by a process manager.
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit())
+
+    logger.info(f"Watching for unindexed posts every {interval} seconds")
+
+    last = 0
+    while True:
+        try:
+            writer = ix.writer()
+        except LockError:
+            logger.info("Index is locked by another writer, waiting")
+            time.sleep(interval)
+            continue
+
+        # Posts deleted from the database are removed in the same commit.
+        with search.queued_deletes() as deleted:
+            try:
+                for uid in deleted:
+                    writer.delete_by_term('uid', uid)
+                ids = search.sync_index(writer=writer, last=last, size=size)
+            except Exception:
+                writer.cancel()
+                raise
+
+            if ids or deleted:
+                writer.commit()
+            else:
+                writer.cancel()
+
+        if ids or deleted:
+            Post.objects.filter(id__in=ids).update(indexed=True)
+            autocomplete.update(ids, completions=completions)
+            logger.info(f"Committed {len(ids)} posts and removed {len(deleted)} deleted posts")
+
+        # Continue after the last post seen, start over once the end is reached.
+        last = ids[-1] if ids else 0
+
+        # Wait for more posts once caught up.
+        if not ids:
+            time.sleep(interval)
 
 
 class Command(BaseCommand):
@@ -60,6 +128,11 @@ class Command(BaseCommand):
         parser.add_argument('--remove', action='store_true', default=False, help="Removes the existing index.")
         parser.add_argument('--report', action='store_true', default=False, help="Reports on the content of the index.")
         parser.add_argument('--size', type=int, default=0, help="How many posts to index")
+        parser.add_argument('--parallel', type=int, default=0,
+                            help="Rebuild the whole index with this many processes.")
+        parser.add_argument('--watch', action='store_true', default=False,
+                            help="Keep indexing posts as they change, until interrupted.")
+        parser.add_argument('--interval', type=int, default=5, help="Seconds between checks for new posts.")
 
     def handle(self, *args, **options):
 
@@ -69,12 +142,27 @@ class Command(BaseCommand):
         remove = options['remove']
         report = options['report']
         size = options['size']
+        interval = options['interval']
 
         # Sets the un-indexed flags to false on all posts.
         if reset:
             logger.info(f"Setting indexed field to false on all post.")
             Post.objects.valid_posts(indexed=True).exclude(root=None).update(indexed=False)
 
+        # Rebuild the index from scratch, in id ranges of size posts.
+        if options['parallel']:
+            rebuild(procs=options['parallel'], size=size or settings.BATCH_INDEXING_SIZE)
+            return
+
+        # Keep the index up to date as posts change, the postgres backend updates itself.
+        if options['watch'] and settings.SEARCH_BACKEND != 'whoosh':
+            logger.warning(f"The {settings.SEARCH_BACKEND} search backend needs no watcher.")
+            return
+
+        if options['watch']:
+            watch(size=size or settings.BATCH_INDEXING_SIZE, interval=interval)
+            return
+
         # Index a limited number yet unindexed posts
         if size:
             build(size=size, remove=remove)
@@ -0,0 +1,173 @@
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from biostar.forum import markdown
+from biostar.forum.bench import PACKAGES, WORDS, percentiles, write_report
+from biostar.forum.models import Post
+
+# Kinds of posts in the synthetic corpus.
+KINDS = ['prose', 'code', 'session', 'links', 'long_line']
+
+# Commands pasted into code blocks.
+COMMANDS = ['samtools sort -@ 8 -o {0}.sorted.bam {0}.bam', 'bwa mem -t 8 ref.fa {0}_R1.fq.gz {0}_R2.fq.gz > {0}.sam',
+            'bedtools intersect -a {0}.bed -b peaks.bed -wa -u', 'awk \'$3 == "gene" {{ print $1, $4, $5 }}\' {0}.gtf']
+
+
+def words(rng, low, high):
+    return ' '.join(rng.choice(WORDS + PACKAGES) for _ in range(rng.randint(low, high)))
+
+
+def prose(rng):
+    paras = [words(rng, 30, 120) for _ in range(rng.randint(2, 6))]
+    items = '\n'.join(f"* **{rng.choice(PACKAGES)}** {words(rng, 3, 10)}" for _ in range(rng.randint(2, 5)))
+    return '\n\n'.join(paras + [items])
+
+
+def code(rng):
+    lines = [rng.choice(COMMANDS).format(f"sample{index}") for index in range(rng.randint(5, 30))]
+    block = '\n'.join(lines)
+    return f"{words(rng, 10, 30)}\n\n```\n{block}\n```\n\nI also tried `{rng.choice(lines)}` with the same result."
+
+
+def session(rng):
+    lines = ['> library(DESeq2)', '> dds <- DESeqDataSetFromMatrix(counts, coldata, design = ~ condition)',
+             '> res <- results(DESeq(dds))', '> head(res, 200)',
+             '       baseMean log2FoldChange     lfcSE      stat    pvalue      padj']
+    for index in range(rng.randint(100, 400)):
+        values = ' '.join(f"{rng.uniform(-10, 1000):10.4f}" for _ in range(6))
+        lines.append(f"ENSG{index:011d} {values}")
+    body = '\n'.join(f"    {line}" for line in lines)
+    return f"My R session:\n\n{body}\n\nWhy are the padj values NA?"
+
+
+def links(rng):
+    site = f"{settings.PROTOCOL}://{markdown.SITE_URL}"
+    targets = [f"{site}/p/{rng.randint(1, 1000)}/", f"{site}/p/{rng.randint(1, 1000)}/#{rng.randint(1, 1000)}",
+               f"{site}/u/{rng.randint(1, 1000)}", f"@user{rng.randint(1, 1000)}",
+               f"https://www.youtube.com/watch?v=bench{rng.randint(1, 1000)}",
+               f"https://github.com/{rng.choice(PACKAGES)}/{rng.choice(PACKAGES)}/issues/{rng.randint(1, 999)}"]
+    return '\n\n'.join(f"{words(rng, 3, 12)} {rng.choice(targets)}" for _ in range(rng.randint(10, 40)))
+
+
+def long_line(rng):
+    # Long runs of text without line breaks stress the inline text rule.
+    return ' '.join(rng.choice(WORDS + ['@', '*', '_', 'http:', '`']) for _ in range(rng.randint(500, 2000)))
+
+
+def synthetic_posts(size, rng):
+    """
+    Generates size markdown texts, a mix of every kind of post.
+    """
+    makers = dict(prose=prose, code=code, session=session, links=links, long_line=long_line)
+    for index in range(size):
+        kind = KINDS[index % len(KINDS)]
+        yield kind, makers[kind](rng)
+
+
+def database_posts(size):
+    """
+    Generates the content of the latest size posts in the database.
+    """
+    for content in Post.objects.order_by('-id').values_list('content', flat=True)[:size].iterator():
+        yield 'database', content
+
+
+def timings(posts):
+    """
+    Renders every post, returns the seconds spent in each stage and in total, per stage and per kind.
+    """
+    stages, kinds = defaultdict(list), defaultdict(list)
+    slowest = (0, '')
+
+    for kind, text in posts:
+        spent = {}
+        markdown.render(text, clean=True, escape=False, timings=spent)
+        total = sum(spent.values())
+        for stage, value in spent.items():
+            stages[stage].append(value)
+        stages['total'].append(total)
+        kinds[kind].append(total)
+        slowest = max(slowest, (total, kind))
+
+    return stages, kinds, slowest
+
+
+def allocations(posts):
+    """
+    Runs the stages one by one, returns the peak bytes allocated by each stage.
+    """
+    peaks = defaultdict(list)
+
+    def measure(stage, func, *args, **kwargs):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        result = func(*args, **kwargs)
+        peaks[stage].append(tracemalloc.get_traced_memory()[1] - base)
+        return result
+
+    tracemalloc.start()
+    try:
+        for kind, text in posts:
+            refs = measure('resolve', markdown.resolve, text)
+            html = measure('mistune', markdown.to_html, text, refs=refs, escape=False)
+            html = measure('clean', markdown.sanitize, html)
+            measure('linkify', markdown.linkify, html, embeds=refs['embeds'])
+    finally:
+        tracemalloc.stop()
+
+    return {stage: dict(mean_kb=round(sum(values) / len(values) / 1024, 1), max_kb=round(max(values) / 1024, 1))
+            for stage, values in peaks.items()}
+
+
+def run(posts, memory=True):
+    """
+    Benchmarks the markdown stages on the posts, returns the report.
+    """
+    # Slow renders are expected here, they are reported below.
+    with override_settings(MARKDOWN_SLOW_RENDER=0):
+        start = time.perf_counter()
+        stages, kinds, slowest = timings(posts)
+        elapsed = time.perf_counter() - start
+
+        memory = allocations(posts) if memory else {}
+
+    report = dict(
+        corpus=dict(posts=len(posts), characters=sum(len(text) for kind, text in posts)),
+        seconds=round(elapsed, 3),
+        stages={stage: percentiles(values) for stage, values in stages.items()},
+        kinds={kind: percentiles(values) for kind, values in kinds.items()},
+        slowest=dict(kind=slowest[1], ms=round(slowest[0] * 1000, 3)),
+        allocations=memory,
+    )
+    return report
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the stages of the markdown renderer on a synthetic or exported corpus and report JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=500, help="Number of posts in the corpus.")
+        parser.add_argument('--seed', type=int, default=1, help="Random seed of the corpus.")
+        parser.add_argument('--database', action='store_true', default=False,
+                            help="Render the latest posts from the database instead of a synthetic corpus.")
+        parser.add_argument('--nomemory', action='store_true', default=False,
+                            help="Skip measuring the allocations, it slows the stages down.")
+        parser.add_argument('--output', type=str, default='', help="Write the report to this file.")
+
+    def handle(self, *args, **options):
+        size = options['size']
+
+        if options['database']:
+            posts = list(database_posts(size))
+        else:
+            posts = list(synthetic_posts(size, random.Random(options['seed'])))
+
+        report = run(posts, memory=not options['nomemory'])
+        report.update(source='database' if options['database'] else 'synthetic', seed=options['seed'])
+        write_report(report, output=options['output'])
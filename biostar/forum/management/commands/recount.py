@@ -0,0 +1,70 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, Q
+
+from biostar.forum.models import Post
+
+logger = logging.getLogger('engine')
+
+FIELDS = ['reply_count', 'answer_count', 'comment_count']
+
+
+def expected_counts():
+    """
+    Returns the reply, answer and comment counts every post should have, keyed by post id.
+
+    Matches Post.update_parent_counts: top level posts count their valid descendants,
+    other posts count their direct replies and have no answers.
+    """
+
+    # One grouped query per level.
+    descendants = Post.objects.exclude(root_id=F('id')).exclude(Q(status=Post.DELETED) | Q(spam=Post.SPAM))
+    roots = descendants.values('root_id').annotate(reply_count=Count('id'),
+                                                   answer_count=Count('id', filter=Q(type=Post.ANSWER)),
+                                                   comment_count=Count('id', filter=Q(type=Post.COMMENT)))
+
+    children = Post.objects.exclude(parent_id=F('id')).filter(parent__is_toplevel=False)
+    parents = children.values('parent_id').annotate(reply_count=Count('id'),
+                                                     comment_count=Count('id', filter=Q(type=Post.COMMENT)))
+
+    expected = {row['root_id']: (row['reply_count'], row['answer_count'], row['comment_count']) for row in roots}
+    expected.update((row['parent_id'], (row['reply_count'], 0, row['comment_count'])) for row in parents)
+
+    return expected
+
+
+def recount(batch=1000, dry_run=False):
+    """
+    Fixes the counts that drifted from the posts in the database, in bulk.
+    """
+
+    expected = expected_counts()
+
+    # Posts without replies should have zero counts.
+    stored = Post.objects.values_list('id', *FIELDS)
+
+    drifted = []
+    for pid, *counts in stored.iterator():
+        correct = expected.get(pid, (0, 0, 0))
+        if tuple(counts) != correct:
+            drifted.append(Post(id=pid, **dict(zip(FIELDS, correct))))
+
+    logger.info(f"Found {len(drifted)} posts with drifted counts")
+
+    if not dry_run:
+        Post.objects.bulk_update(drifted, FIELDS, batch_size=batch)
+
+    return len(drifted)
+
+
+class Command(BaseCommand):
+    help = 'Recompute the reply, answer and comment counts of every post.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=1000, help="Posts updated per query.")
+        parser.add_argument('--dry_run', action='store_true', default=False,
+                            help="Only report how many posts have drifted.")
+
+    def handle(self, *args, **options):
+        recount(batch=options['batch'], dry_run=options['dry_run'])
@@ -0,0 +1,138 @@
+import difflib
+import logging
+import multiprocessing
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Max, Min
+
+from biostar.forum import markdown
+from biostar.forum.models import Post, delete_post_cache
+
+logger = logging.getLogger('engine')
+
+# Last post id rendered by an interrupted run.
+CHECKPOINT = os.path.join(settings.BASE_DIR, "export", "rerender.checkpoint")
+
+
+def render_range(bounds):
+    """
+    Renders the posts with ids in the [start, end) range, returns the ones whose html changed.
+    Runs in the worker processes.
+    """
+    start, end = bounds
+    rows = Post.objects.filter(id__gte=start, id__lt=end).order_by('id')
+    rows = list(rows.values_list('id', 'uid', 'content', 'html'))
+
+    # The links of the whole range are looked up together.
+    refs = markdown.resolve("\n".join(row[2] for row in rows))
+
+    changed = []
+    for pk, uid, content, html in rows:
+        new = markdown.render(content, clean=True, escape=False, refs=refs)
+        if new != html:
+            changed.append((pk, uid, html, new, markdown.digest(content, refs=refs, clean=True, escape=False)))
+
+    return changed
+
+
+def write(changed, batch=500):
+    """
+    Stores the new html without going through Post.save and its signals.
+    """
+    posts = [Post(id=pk, html=new, content_hash=digest) for pk, uid, old, new, digest in changed]
+    Post.objects.bulk_update(posts, ['html', 'content_hash'], batch_size=batch)
+
+    # Cached copies of the threads are out of date.
+    ids = [post.id for post in posts]
+    for post in Post.objects.filter(id__in=ids).select_related('root').only('uid', 'root', 'root__uid'):
+        delete_post_cache(post)
+
+
+def show_diff(changed):
+    for pk, uid, old, new, digest in changed:
+        lines = difflib.unified_diff(old.splitlines(), new.splitlines(), fromfile=f"{uid} stored",
+                                     tofile=f"{uid} rendered", lineterm='')
+        print("\n".join(lines))
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as stream:
+            return int(stream.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def save_checkpoint(path, last):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as stream:
+        stream.write(f"{last}\n")
+
+
+def rerender(procs=1, size=1000, batch=500, dry=False, resume=False, checkpoint=CHECKPOINT):
+    """
+    Renders the html of every post again, in id ranges of the given size spread over procs processes.
+
+    Progress is saved to the checkpoint after each range so an interrupted run can resume.
+    A dry run prints the differences and writes nothing. Returns the number of posts that changed.
+    """
+    bounds = Post.objects.aggregate(start=Min('id'), end=Max('id'))
+    start, end = bounds['start'] or 0, bounds['end'] or 0
+
+    if resume:
+        start = max(start, read_checkpoint(checkpoint) + 1)
+        logger.info(f"Resuming after post id {start - 1}")
+
+    ranges = [(lo, lo + size) for lo in range(start, end + 1, size)]
+
+    if procs > 1:
+        # Worker processes must not share the database connection of the parent.
+        connections.close_all()
+        pool = multiprocessing.Pool(procs)
+        # Ranges come back in order so the checkpoint never skips one.
+        stream = pool.imap(render_range, ranges)
+    else:
+        pool, stream = None, map(render_range, ranges)
+
+    total = 0
+    try:
+        for (lo, hi), changed in zip(ranges, stream):
+            total += len(changed)
+            if dry:
+                show_diff(changed)
+                continue
+            write(changed, batch=batch)
+            save_checkpoint(checkpoint, hi - 1)
+            logger.info(f"Rendered posts up to id {hi - 1}, {total} changed")
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    # A finished run starts over next time.
+    if not dry and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    logger.info(f"{total} posts {'would change' if dry else 'changed'}")
+    return total
+
+
+class Command(BaseCommand):
+    help = 'Render the html of every post again, after a change to the markdown rules.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--procs', type=int, default=1, help="Number of rendering processes.")
+        parser.add_argument('--size', type=int, default=1000, help="Range of post ids rendered by a process at once.")
+        parser.add_argument('--batch', type=int, default=500, help="Posts written per update query.")
+        parser.add_argument('--dry', action='store_true', default=False,
+                            help="Print the changes to the html, write nothing.")
+        parser.add_argument('--resume', action='store_true', default=False,
+                            help="Continue after the last range written by an interrupted run.")
+        parser.add_argument('--checkpoint', default=CHECKPOINT, help="File keeping the progress of the run.")
+
+    def handle(self, *args, **options):
+        rerender(procs=options['procs'], size=options['size'], batch=options['batch'], dry=options['dry'],
+                 resume=options['resume'], checkpoint=options['checkpoint'])
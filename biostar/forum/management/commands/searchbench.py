@@ -0,0 +1,167 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+from django.test import override_settings
+from whoosh.index import create_in
+
+from biostar.forum import search, util
+from biostar.forum.bench import PACKAGES, WORDS, percentiles, write_report
+from biostar.forum.models import Post
+
+# Error messages users paste into posts.
+ERRORS = ['segmentation fault', 'command not found', 'out of memory', 'permission denied',
+          'no such file or directory', 'truncated file', 'invalid header', 'index out of range']
+
+# Multi word phrases.
+PHRASES = ['differential expression analysis', 'variant calling pipeline', 'read alignment quality',
+           'single cell clustering', 'gene ontology enrichment', 'convert bam to fastq',
+           'remove duplicate reads', 'count reads per gene']
+
+# Weighted query log: package names are the most common queries.
+QUERY_LOG = [(5, q) for q in PACKAGES] + [(3, q) for q in ERRORS] + [(2, q) for q in PHRASES]
+
+
+def read_log(fname):
+    """
+    Reads a query log of weight and query separated by a tab, one per line.
+    """
+    with open(fname, 'rt', encoding='utf-8') as stream:
+        lines = [line.strip().split('\t', 1) for line in stream if line.strip()]
+    return [(int(weight), query) for weight, query in lines]
+
+
+def synthetic_docs(size, rng):
+    """
+    Generates the index documents of size posts built from the query log vocabulary.
+    """
+    vocab = WORDS * 4 + PACKAGES + ' '.join(ERRORS + PHRASES).split()
+    now = util.now()
+
+    for index in range(size):
+        words = lambda low, high: ' '.join(rng.choice(vocab) for _ in range(rng.randint(low, high)))
+        content = '\n\n'.join(words(20, 80) for _ in range(rng.randint(1, 5)))
+        yield dict(title=words(4, 12),
+                   content=content,
+                   excerpt=content[:settings.SEARCH_EXCERPT_LENGTH],
+                   tags=','.join(rng.sample(PACKAGES, rng.randint(1, 4))),
+                   author=f"User {rng.randint(1, 1000)}",
+                   uid=f"bench{index}",
+                   lastedit_date=now - timedelta(minutes=index))
+
+
+def database_docs(size, step=1000):
+    """
+    Generates the index documents of up to size posts exported from the database.
+    """
+    bounds = Post.objects.aggregate(start=Min('id'), end=Max('id'))
+    start, end = bounds['start'] or 0, bounds['end'] or 0
+
+    total = 0
+    for lo in range(start, end + 1, step):
+        ids, docs = search.index_range((lo, lo + step))
+        for fields in docs:
+            if total >= size:
+                return
+            total += 1
+            yield fields
+
+
+def replay(func, params):
+    """
+    Times func over each of the keyword arguments in params.
+    """
+    timings = []
+    for kwargs in params:
+        start = time.perf_counter()
+        func(**kwargs)
+        timings.append(time.perf_counter() - start)
+    return percentiles(timings)
+
+
+def dir_size(dirname):
+    return sum(entry.stat().st_size for entry in os.scandir(dirname) if entry.is_file())
+
+
+def run(dirname, docs, size, queries, similar, rng, procs, log):
+    indexname = 'bench'
+    os.makedirs(dirname, exist_ok=True)
+    ix = create_in(dirname=dirname, schema=search.get_schema(), indexname=indexname)
+
+    # Build the index.
+    start = time.perf_counter()
+    writer = ix.writer(procs=procs, multisegment=procs > 1, limitmb=256)
+    uids = []
+    for fields in docs:
+        writer.add_document(**fields)
+        uids.append(fields['uid'])
+    writer.commit()
+    build = time.perf_counter() - start
+
+    # Replay the query log.
+    weights, texts = zip(*log)
+    sample = rng.choices(texts, weights=weights, k=queries)
+    params = [dict(query=text) for text in sample]
+    mlt = [dict(uid=uid) for uid in rng.sample(uids, min(similar, len(uids)))]
+
+    # Measure the search itself, not the result cache.
+    with override_settings(INDEX_DIR=dirname, INDEX_NAME=indexname, SEARCH_BACKEND='whoosh',
+                           SEARCH_CACHE_SIZE=0, SEARCH_CACHE_BACKEND=''):
+        search_stats = replay(search.perform_search, params)
+        similar_stats = replay(search.more_like_this, mlt)
+
+    with ix.reader() as reader:
+        segments = len(reader.leaf_readers())
+
+    report = dict(
+        corpus=dict(posts=len(uids), requested=size),
+        build=dict(seconds=round(build, 3), posts_per_second=round(len(uids) / build, 1) if build else 0,
+                   procs=procs),
+        index=dict(bytes=dir_size(dirname), segments=segments),
+        search=search_stats,
+        more_like_this=similar_stats,
+    )
+
+    return report
+
+
+class Command(BaseCommand):
+    help = 'Benchmark search latency on a synthetic or exported corpus and report JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=1000, help="Number of posts in the corpus.")
+        parser.add_argument('--queries', type=int, default=500, help="Number of searches replayed.")
+        parser.add_argument('--similar', type=int, default=100, help="Number of more like this searches.")
+        parser.add_argument('--seed', type=int, default=1, help="Random seed of the corpus and the query sample.")
+        parser.add_argument('--procs', type=int, default=1, help="Processes used to write the index.")
+        parser.add_argument('--database', action='store_true', default=False,
+                            help="Index posts from the database instead of a synthetic corpus.")
+        parser.add_argument('--log', type=str, default='', help="Query log with a weight and a query per line.")
+        parser.add_argument('--output', type=str, default='', help="Write the report to this file.")
+
+    def handle(self, *args, **options):
+        size = options['size']
+        rng = random.Random(options['seed'])
+        log = read_log(options['log']) if options['log'] else QUERY_LOG
+
+        if options['database']:
+            docs = database_docs(size)
+        else:
+            docs = synthetic_docs(size, rng)
+
+        dirname = tempfile.mkdtemp(prefix='searchbench')
+        try:
+            report = run(dirname=dirname, docs=docs, size=size, queries=options['queries'],
+                         similar=options['similar'], rng=rng, procs=options['procs'], log=log)
+        finally:
+            search.SEARCHERS.close(dirname=dirname, indexname='bench')
+            shutil.rmtree(dirname, ignore_errors=True)
+
+        report.update(source='database' if options['database'] else 'synthetic', seed=options['seed'])
+        write_report(report, output=options['output'])
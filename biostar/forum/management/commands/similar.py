@@ -0,0 +1,54 @@
+import logging
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import F, Q
+
+from biostar.forum import search
+from biostar.forum.models import Post
+from biostar.utils.decorators import check_lock
+
+logger = logging.getLogger('engine')
+
+LOCK = os.path.join(settings.INDEX_DIR, 'similar')
+
+
+@check_lock(LOCK)
+def build(size, reset=False):
+    """
+    Computes the similar posts of toplevel posts that changed since their last computation.
+    """
+
+    posts = Post.objects.valid_posts(is_toplevel=True)
+
+    # Only posts never computed or edited since.
+    if not reset:
+        posts = posts.filter(Q(similar=None) | Q(lastedit_date__gt=F('similar__date')))
+
+    posts = posts.order_by('id')
+
+    # Walk the posts in id order so each one is visited once per run.
+    last, total = 0, 0
+    while True:
+        batch = list(posts.filter(id__gt=last)[:size])
+        if not batch:
+            break
+        total += search.compute_similar(posts=batch)
+        last = batch[-1].id
+
+    logger.info(f"Computed similar posts for {total} posts")
+
+
+class Command(BaseCommand):
+    help = 'Precompute similar posts from the search index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', default=False,
+                            help="Recompute the similar posts of every post.")
+        parser.add_argument('--size', type=int, default=0, help="How many posts to compute in one batch.")
+
+    def handle(self, *args, **options):
+        size = options['size'] or settings.BATCH_INDEXING_SIZE
+
+        build(size=size, reset=options['reset'])
@@ -0,0 +1,63 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+
+from biostar.forum.models import Post, SHOWN, set_visible
+
+logger = logging.getLogger('engine')
+
+
+def mismatched():
+    """
+    Returns the posts whose visible flag disagrees with their own and their root's state.
+    """
+    shown = Post.objects.filter(SHOWN).values('pk')
+    hidden = Post.objects.filter(visible=False, pk__in=shown)
+    exposed = Post.objects.filter(visible=True).exclude(pk__in=shown)
+    return hidden, exposed
+
+
+def check(limit=10):
+    """
+    Reports the posts with a wrong visible flag, returns their number.
+    """
+    hidden, exposed = mismatched()
+    for label, query in (("hidden", hidden), ("exposed", exposed)):
+        count = query.count()
+        uids = ', '.join(query.values_list('uid', flat=True)[:limit])
+        if count:
+            logger.warning(f"{count} posts wrongly {label}: {uids}")
+
+    total = hidden.count() + exposed.count()
+    logger.info(f"Found {total} posts with a wrong visible flag")
+    return total
+
+
+def backfill(batch=10000):
+    """
+    Sets the visible flag of every post, one range of threads at a time.
+    """
+    bounds = Post.objects.aggregate(start=Min('root_id'), end=Max('root_id'))
+    start, end = bounds['start'] or 0, bounds['end'] or 0
+
+    for lo in range(start, end + 1, batch):
+        set_visible(Post.objects.filter(root_id__gte=lo, root_id__lt=lo + batch))
+
+    # Posts outside of a thread are never shown.
+    Post.objects.filter(root=None, visible=True).update(visible=False)
+
+
+class Command(BaseCommand):
+    help = 'Fill in or check the visible flag of every post.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=10000, help="Range of thread ids updated per query.")
+        parser.add_argument('--check', action='store_true', default=False,
+                            help="Only report the posts with a wrong visible flag.")
+
+    def handle(self, *args, **options):
+        if options['check']:
+            check()
+        else:
+            backfill(batch=options['batch'])
@@ -2,7 +2,13 @@
 Markdown parser to render the Biostar style markdown.
 """
 import re
+import json
+import hashlib
+import threading
+import time
 import inspect, logging
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import partial
 import mistune
 import requests
@@ -17,13 +23,16 @@ from django.conf import settings
 from mistune import Renderer, InlineLexer, InlineGrammar
 from mistune import escape as escape_text
 from bleach.sanitizer import Cleaner
-from biostar.forum import auth
-from biostar.forum.models import Post, Subscription
+from django.utils.module_loading import import_string
+from biostar.forum.models import Post, Subscription, Rendered, Embed
 from biostar.accounts.models import Profile, User
 from bleach.callbacks import nofollow
 
 logger = logging.getLogger('engine')
 
+# Change when the renderer changes, cached renderings of older versions are not used.
+RENDER_VERSION = 1
+
 # Test input.
 TEST_INPUT = '''
 
@@ -71,6 +80,9 @@ POST_ANCHOR = rec(fr"http(s)?://{SITE_URL}/p/\w+/\#(?P<uid>(\w+))(/)?")
 # These characters are allowed in handles: _  .  -
 MENTINONED_USERS = rec(r"(\@(?P<handle>[\w_.'-]+))")
 
+# Code blocks and spans, mentions in them are not links.
+CODE_PATTERN = rec(r"```[\s\S]*?```|`[^`\n]*`|^(?: {4}|\t).*$", re.MULTILINE)
+
 ALLOWED_ATTRIBUTES = {
     '*': ['class', 'style'],
     'a': ['href', 'rel'],
@@ -107,23 +119,55 @@ GIST_HTML = '<script src="https://gist.github.com/%s.js"></script>'
 # https://twitter.com/Linux/status/2311234267
 TWITTER_PATTERN = rec(r"http(s)?://(www)?.?twitter.com/\w+/status(es)?/(?P<uid>([\d]+))(/)?([^\s]+)?")
 
+# Tweets are embedded by their canonical url.
+TWEET_URL = "https://twitter.com/twitter/status/%s"
+
+# The oEmbed endpoint for tweets.
+OEMBED_URL = "https://publish.twitter.com/oembed"
 
-def get_tweet(tweet_id):
+
+def fetch_oembed(url):
     """
-    Get the HTML code with the embedded tweet.
-    It requires an API call at https://api.twitter.com/1/statuses/oembed.json as documented here:
-    https://dev.twitter.com/docs/embedded-tweets - section "Embedded Tweets for Developers"
-    https://dev.twitter.com/docs/api/1/get/statuses/oembed
-    Params:
-    tweet_id -- a tweet's numeric id like 2311234267 for the tweet at
-    https://twitter.com/Linux/status/2311234267
+    Fetches the html of an embedded tweet from the oEmbed endpoint, see settings.EMBED_FETCHER.
     """
-    try:
-        response = requests.get("https://api.twitter.com/1/statuses/oembed.json?id={}".format(
-            tweet_id))
-        return response.json()['html']
-    except:
-        return ''
+    response = requests.get(OEMBED_URL, params=dict(url=url), timeout=settings.EMBED_TIMEOUT)
+    response.raise_for_status()
+    return response.json()['html']
+
+
+def embed_urls(text):
+    """
+    Returns the canonical urls of the links in the text that are embedded.
+    """
+    return {TWEET_URL % m.group("uid") for m in TWITTER_PATTERN.finditer(text)}
+
+
+def missing_embeds(text):
+    """
+    Returns the embed urls of the text that are not stored yet.
+    """
+    urls = embed_urls(text)
+    if not urls:
+        return urls
+    return urls - set(Embed.objects.filter(url__in=urls).values_list("url", flat=True))
+
+
+def fetch_embeds(text):
+    """
+    Fetches and stores the embeds of the text that are not stored yet, returns the number stored.
+    """
+    fetcher = import_string(settings.EMBED_FETCHER)
+    count = 0
+    for url in missing_embeds(text):
+        try:
+            html = fetcher(url)
+        except Exception as exc:
+            logger.warning(f"Error fetching embed for {url}: {exc}")
+            continue
+        Embed.objects.update_or_create(url=url, defaults=dict(html=html))
+        count += 1
+
+    return count
 
 
 class MonkeyPatch(InlineLexer):
@@ -189,15 +233,66 @@ def rewrite_static(link):
     return link
 
 
+def references(text):
+    """
+    Returns the handles, post uids, profile uids and embed urls linked in the text, keyed like the refs.
+    """
+    return dict(handles={m.group("handle") for m in MENTINONED_USERS.finditer(text)},
+                titles={m.group("uid") for patt in (POST_TOPLEVEL, POST_ANCHOR) for m in patt.finditer(text)},
+                names={m.group("uid") for m in USER_PATTERN.finditer(text)},
+                embeds=embed_urls(text))
+
+
+def resolve(text):
+    """
+    Looks up the users and posts linked in the text, with one query for each kind of link.
+    """
+    found = references(text)
+    handles, post_uids, user_uids, urls = found["handles"], found["titles"], found["names"], found["embeds"]
+
+    refs = dict(handles={}, titles={}, names={}, embeds={})
+
+    if handles:
+        users = Profile.objects.filter(handle__in=handles).order_by("user_id")
+        # The first user with a handle gets the mention.
+        for handle, uid, name in users.values_list("handle", "uid", "name"):
+            refs["handles"].setdefault(handle, (uid, name))
+
+    if post_uids:
+        posts = Post.objects.filter(uid__in=post_uids).values_list("uid", "root__title")
+        refs["titles"].update(posts)
+
+    if user_uids:
+        profiles = Profile.objects.filter(uid__in=user_uids).values_list("uid", "name")
+        refs["names"].update(profiles)
+
+    if urls:
+        embeds = Embed.objects.filter(url__in=urls).values_list("url", "html")
+        refs["embeds"].update(embeds)
+
+    return refs
+
+
+def mentions(text):
+    """
+    Returns the users mentioned outside of the code in the text.
+    """
+    handles = {m.group("handle") for m in MENTINONED_USERS.finditer(CODE_PATTERN.sub("", text))}
+    if not handles:
+        return []
+    users = User.objects.filter(profile__handle__in=handles).select_related("profile")
+    return list(users)
+
+
 class BiostarInlineLexer(MonkeyPatch):
     grammar_class = BiostarInlineGrammer
 
-    def __init__(self, root=None, allow_rewrite=False, *args, **kwargs):
+    def __init__(self, refs=None, allow_rewrite=False, *args, **kwargs):
         """
-        :param root: Root post that is being pared
-        :param static_imgs:
+        :param refs: Users and posts linked in the text, see resolve.
+        :param allow_rewrite: Serve relative image paths from the static directory.
         """
-        self.root = root
+        self.refs = refs or dict(handles={}, titles={}, names={}, embeds={})
         self.allow_rewrite = allow_rewrite
 
         super(BiostarInlineLexer, self).__init__(*args, **kwargs)
@@ -241,15 +336,12 @@ class BiostarInlineLexer(MonkeyPatch):
     def output_mention_link(self, m):
 
         handle = m.group("handle")
-        # Query user and get the link
-        user = User.objects.filter(profile__handle=handle).first()
+        # Link to the user resolved before parsing.
+        user = self.refs["handles"].get(handle)
         if user:
-            profile = reverse("user_profile", kwargs=dict(uid=user.profile.uid))
-            link = f'<a href="{profile}">{user.profile.name}</a>'
-            # Subscribe mentioned users to post.
-            if self.root:
-                # Create user subscription if it does not already exist.
-                auth.create_subscription(post=self.root, user=user, update=True)
+            uid, name = user
+            profile = reverse("user_profile", kwargs=dict(uid=uid))
+            link = f'<a href="{profile}">{name}</a>'
         else:
             link = m.group(0)
 
@@ -258,8 +350,7 @@ class BiostarInlineLexer(MonkeyPatch):
     def output_post_link(self, m):
         uid = m.group("uid")
         link = m.group(0)
-        post = Post.objects.filter(uid=uid).first()
-        title = post.root.title if post else "Post not found"
+        title = self.refs["titles"].get(uid) or "Post not found"
         return f'<a href="{link}">{title}</a>'
 
     def enable_anchor_link(self):
@@ -269,8 +360,7 @@ class BiostarInlineLexer(MonkeyPatch):
     def output_anchor_link(self, m):
         uid = m.group("uid")
         link = m.group(0)
-        post = Post.objects.filter(uid=uid).first()
-        title = post.root.title if post else "Post not found"
+        title = self.refs["titles"].get(uid) or "Post not found"
         return f'<a href="{link}">{title}</a>'
 
     def enable_user_link(self):
@@ -280,8 +370,7 @@ class BiostarInlineLexer(MonkeyPatch):
     def output_user_link(self, m):
         uid = m.group("uid")
         link = m.group(0)
-        profile = Profile.objects.filter(uid=uid).first()
-        name = profile.name if profile else f"Invalid user uid: {uid}"
+        name = self.refs["names"].get(uid, f"Invalid user uid: {uid}")
         return f'<a href="{link}">{name}</a>'
 
     def enable_youtube_link1(self):
@@ -338,8 +427,15 @@ class BiostarInlineLexer(MonkeyPatch):
         return f'<a href="{link}">{link}</a>'
 
 
-def embedder(attrs, new, embed=None):
+def embedder(attrs, new, embed=None, embeds=None, pending=None):
+    """
+    Collects the links that are replaced by an embed.
+
+    Tweets come from the stored embeds, a tweet not stored yet stays a link and is added to pending.
+    """
     embed = [] if embed is None else embed
+    embeds = {} if embeds is None else embeds
+    pending = [] if pending is None else pending
 
     # Existing <a> tag, leave as is.
     if not new:
@@ -358,7 +454,7 @@ def embedder(attrs, new, embed=None):
         (YOUTUBE_PATTERN1, lambda x: YOUTUBE_HTML % x),
         (YOUTUBE_PATTERN2, lambda x: YOUTUBE_HTML % x),
         (YOUTUBE_PATTERN3, lambda x: YOUTUBE_HTML % x),
-        (TWITTER_PATTERN, get_tweet),
+        (TWITTER_PATTERN, lambda x: embeds.get(TWEET_URL % x)),
     ]
 
     for regex, get_text in targets:
@@ -366,6 +462,11 @@ def embedder(attrs, new, embed=None):
         if patt:
             uid = patt.group("uid")
             obj = get_text(uid)
+            # Links without an embed stay links.
+            if not obj:
+                if obj is None:
+                    pending.append(href)
+                continue
             embed.append((patt.group(), obj))
             attrs['_text'] = patt.group()
             if 'rel' in attrs:
@@ -374,10 +475,11 @@ def embedder(attrs, new, embed=None):
     return attrs
 
 
-def linkify(text):
+def linkify(text, embeds=None, pending=None):
     # List of links to embed
     embed = []
-    html = bleach.linkify(text=text, callbacks=[partial(embedder, embed=embed), nofollow], skip_tags=['pre', 'code'])
+    callback = partial(embedder, embed=embed, embeds=embeds, pending=pending)
+    html = bleach.linkify(text=text, callbacks=[callback, nofollow], skip_tags=['pre', 'code'])
 
     # Embed links into html.
     for em in embed:
@@ -403,8 +505,75 @@ def safe(f):
     return inner
 
 
+def digest(text, refs=None, clean=True, escape=True, allow_rewrite=False):
+    """
+    Returns the key of a rendering: the text, the options, the renderer version
+    and the users, posts and embeds the text links to, as found in refs.
+    """
+    refs = resolve(text) if refs is None else refs
+
+    # Refs resolved for many texts at once are narrowed down to this text.
+    found = references(text)
+    linked = {kind: sorted((name, refs[kind][name]) for name in found[kind] if name in refs[kind])
+              for kind in found}
+
+    key = f"{RENDER_VERSION}-{clean:d}{escape:d}{allow_rewrite:d}-{json.dumps(linked)}-{text}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """
+    Keeps html keyed by the digest of the markdown in a bounded in-process LRU and,
+    when settings.MARKDOWN_CACHE_TABLE is on, in the Rendered table.
+    """
+
+    def __init__(self, size=None):
+        self.lock = threading.Lock()
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if not settings.MARKDOWN_CACHE_TABLE:
+            return None
+
+        html = Rendered.objects.filter(digest=key).values_list("html", flat=True).first()
+        if html is not None:
+            self.remember(key, html)
+        return html
+
+    def remember(self, key, html):
+        size = settings.MARKDOWN_CACHE_SIZE if self.size is None else self.size
+        with self.lock:
+            self.entries[key] = html
+            self.entries.move_to_end(key)
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+    def set(self, key, html):
+        self.remember(key, html)
+
+        if settings.MARKDOWN_CACHE_TABLE:
+            try:
+                Rendered.objects.get_or_create(digest=key, defaults=dict(html=html))
+            except Exception as exc:
+                logger.error(f"Error storing rendered markdown: {exc}")
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# One render cache per process.
+RENDERED = RenderCache()
+
+
 @safe
-def parse(text, post=None, clean=True, escape=True, allow_rewrite=False):
+def parse(text, clean=True, escape=True, allow_rewrite=False, refs=None):
     """
     Parses markdown into html.
     Expands certain patterns into HTML.
@@ -414,29 +583,108 @@ def parse(text, post=None, clean=True, escape=True, allow_rewrite=False):
     escape  : Escape html originally found in the markdown text.
     allow_rewrite : Serve images with relative url paths from the static directory.
                   eg. images/foo.png -> /static/images/foo.png
+    refs : The users, posts and embeds linked in the text, see resolve.
     """
 
-    # Resolve the root if exists.
-    root = post.parent.root if (post and post.parent) else None
+    # The html changes with the linked users and posts, they are part of the key.
+    refs = resolve(text) if refs is None else refs
+
+    # The same text is rendered only once.
+    key = digest(text, refs=refs, clean=clean, escape=escape, allow_rewrite=allow_rewrite)
+    output = RENDERED.get(key)
+    if output is None:
+        pending = []
+        output = render(text, clean=clean, escape=escape, allow_rewrite=allow_rewrite, pending=pending,
+                        refs=refs)
+        # Renderings waiting for an embed are made again once it is fetched.
+        if not pending:
+            RENDERED.set(key, output)
+
+    return output
+
+
+def to_html(text, refs=None, escape=True, allow_rewrite=False):
+    """
+    Converts the markdown into html with mistune and the Biostar rules.
+    """
 
     # Initialize the renderer
     renderer = BiostarRenderer(escape=escape)
 
-    # Initialize the lexer
-    inline = BiostarInlineLexer(renderer=renderer, root=root, allow_rewrite=allow_rewrite)
+    # Initialize the lexer with the linked users and posts.
+    inline = BiostarInlineLexer(renderer=renderer, refs=refs, allow_rewrite=allow_rewrite)
 
     markdown = mistune.Markdown(hard_wrap=True, renderer=renderer, inline=inline)
 
-    output = markdown(text=text)
+    return markdown(text=text)
+
+
+def sanitize(html):
+    """
+    Removes the tags, attributes and protocols that are not allowed.
+    """
+    return bleach.clean(text=html,
+                        tags=ALLOWED_TAGS,
+                        styles=ALLOWED_STYLES,
+                        attributes=ALLOWED_ATTRIBUTES,
+                        protocols=ALLOWED_PROTOCOLS)
+
+
+@contextmanager
+def timed(timings, stage):
+    """
+    Adds the time spent in the block to the stage, in seconds.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+
+
+def log_slow(text, timings):
+    """
+    Logs the stages of renderings slower than settings.MARKDOWN_SLOW_RENDER.
+    """
+    total = sum(timings.values())
+    limit = settings.MARKDOWN_SLOW_RENDER
+    if not limit or total < limit:
+        return
+
+    stages = ' '.join(f"{stage}={value * 1000:.1f}ms" for stage, value in timings.items())
+    logger.warning(f"SLOW: markdown render {total * 1000:.1f}ms for {len(text)} characters, {stages}")
+
+
+def render(text, clean=True, escape=True, allow_rewrite=False, pending=None, refs=None, timings=None):
+    """
+    Renders markdown into html, see parse.
+    Links whose embed is not fetched yet are added to pending.
+    Texts rendered together may share the refs resolved from all of them.
+    The time of each stage is added to timings.
+    """
+    stages = {}
+
+    # Users, posts and embeds linked in the text.
+    with timed(stages, 'resolve'):
+        refs = refs or resolve(text)
+
+    with timed(stages, 'mistune'):
+        output = to_html(text, refs=refs, escape=escape, allow_rewrite=allow_rewrite)
+
     # Bleach clean the html.
     if clean:
-        output = bleach.clean(text=output,
-                            tags=ALLOWED_TAGS,
-                            styles=ALLOWED_STYLES,
-                            attributes=ALLOWED_ATTRIBUTES,
-                            protocols=ALLOWED_PROTOCOLS)
+        with timed(stages, 'clean'):
+            output = sanitize(output)
+
     # Embed sensitive links into html
-    output = linkify(text=output)
+    with timed(stages, 'linkify'):
+        output = linkify(text=output, embeds=refs["embeds"], pending=pending)
+
+    log_slow(text, stages)
+
+    if timings is not None:
+        for stage, value in stages.items():
+            timings[stage] = timings.get(stage, 0) + value
 
     return output
 
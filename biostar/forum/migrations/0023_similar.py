@@ -0,0 +1,23 @@
+# Generated by Django 3.2.12 on 2026-10-17 04:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0022_post_has_diff'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Similar',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uids', models.TextField(default='')),
+                ('date', models.DateTimeField(db_index=True)),
+                ('post', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='similar', to='forum.post')),
+            ],
+        ),
+    ]
@@ -0,0 +1,53 @@
+from django.db import migrations
+
+# The column, trigger and index only exist on PostgreSQL, other databases use the whoosh backend.
+FORWARD = """
+ALTER TABLE forum_post ADD COLUMN search_vector tsvector;
+
+CREATE FUNCTION forum_post_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('english', replace(coalesce(NEW.tag_val, ''), ',', ' ')), 'A') ||
+        setweight(to_tsvector('english', coalesce(NEW.content, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER forum_post_search_vector BEFORE INSERT OR UPDATE OF title, tag_val, content
+    ON forum_post FOR EACH ROW EXECUTE PROCEDURE forum_post_search_vector();
+
+UPDATE forum_post SET search_vector =
+    setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+    setweight(to_tsvector('english', replace(coalesce(tag_val, ''), ',', ' ')), 'A') ||
+    setweight(to_tsvector('english', coalesce(content, '')), 'B');
+
+CREATE INDEX forum_post_search_vector_idx ON forum_post USING gin(search_vector);
+"""
+
+BACKWARD = """
+DROP TRIGGER IF EXISTS forum_post_search_vector ON forum_post;
+DROP FUNCTION IF EXISTS forum_post_search_vector();
+ALTER TABLE forum_post DROP COLUMN IF EXISTS search_vector;
+"""
+
+
+def forward(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(FORWARD)
+
+
+def backward(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(BACKWARD)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0023_similar'),
+    ]
+
+    operations = [
+        migrations.RunPython(forward, backward),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2.12 on 2026-10-17 05:08
+
+from django.db import migrations, models
+from django.db.models import Q
+
+# Post.OPEN, Post.SPAM, Post.NOT_SPAM and Post.DEFAULT.
+OPEN, SPAM, NOT_SPAM, DEFAULT = 1, 0, 1, 2
+
+
+def fill_visible(apps, schema_editor):
+    Post = apps.get_model('forum', 'Post')
+    shown = Q(parent__isnull=False, status=OPEN, spam__in=(NOT_SPAM, DEFAULT),
+              root__status=OPEN, root__spam__in=(NOT_SPAM, DEFAULT))
+    Post.objects.filter(shown).update(visible=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0024_post_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='visible',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['visible', 'is_toplevel', 'rank'], name='forum_post_visible_idx'),
+        ),
+        migrations.RunPython(fill_visible, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.2.12 on 2026-10-17 05:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0026_post_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Embed',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=256, unique=True)),
+                ('html', models.TextField(default='')),
+                ('date', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
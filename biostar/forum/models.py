@@ -1,12 +1,17 @@
+import atexit
+import hashlib
 import logging
+import threading
+import time
+from collections import defaultdict
 from datetime import timedelta
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.sites.models import Site
 from django.core.cache import cache
 from django.core.cache.utils import make_template_fragment_key
-from django.db import models
-from django.db.models import F
+from django.db import models, transaction
+from django.db.models import F, Case, When, Count
 from django.db.models import Q
 from django.shortcuts import reverse
 from taggit.managers import TaggableManager
@@ -15,7 +20,7 @@ from urllib.parse import urlparse
 from biostar.utils import helpers
 from biostar.accounts.models import Profile
 from biostar.planet.models import BlogPost
-from . import util
+from . import util, const
 
 User = get_user_model()
 
@@ -43,12 +48,9 @@ class PostManager(models.Manager):
         if u and u.is_authenticated and u.profile.is_moderator:
             return query
 
-        # Filter for open posts.
-        query = query.filter(status=Post.OPEN, root__status=Post.OPEN)
-
-        # Mark every spam post as 'closed'
-        # This doubles the query time.
-        query = query.exclude(models.Q(spam=Post.SPAM) | models.Q(root__spam=Post.SPAM))
+        # Open posts that are not spam, in open threads that are not spam.
+        # The visible flag is maintained by set_visible, avoiding a join to the root.
+        query = query.filter(visible=True)
 
         return query
 
@@ -68,6 +70,70 @@ def delete_fragment_cache(key, *params):
     cache.delete(key)
 
 
+def get_version(key):
+    """
+    Returns the version stored under a key, cached data is keyed by it.
+    """
+    version = cache.get(key)
+
+    # A lost version starts over at the current time, never at a value used before.
+    if version is None:
+        version = time.time_ns()
+        cache.add(key, version, None)
+        version = cache.get(key, version)
+
+    return version
+
+
+def thread_version(uid):
+    """
+    Returns the version of the thread with the given root uid.
+    """
+    return get_version(f"{const.THREAD_VERSION_KEY}-{uid}")
+
+
+def listing_key(tag='', post_type=None):
+    """
+    Returns the key of the version of a listing: the posts of a tag, of a post type, or the latest posts.
+    """
+    if tag:
+        digest = hashlib.md5(tag.lower().encode()).hexdigest()
+        return f"{const.LISTING_VERSION_KEY}-tag-{digest}"
+    if post_type is not None:
+        return f"{const.LISTING_VERSION_KEY}-type-{post_type}"
+    return f"{const.LISTING_VERSION_KEY}-latest"
+
+
+def listing_version(tag='', post_type=None):
+    """
+    Returns the version of a listing, it changes with the threads listed in it.
+    """
+    return get_version(listing_key(tag=tag, post_type=post_type))
+
+
+def bump_thread(post, tags=()):
+    """
+    Moves the thread of the post and the listings showing it to a new version, invalidating the data cached for them.
+
+    The tags the thread was listed under before an edit are passed in tags.
+    """
+    version = time.time_ns()
+
+    try:
+        root = post if post.root_id in (None, post.id) else post.root
+    except Post.DoesNotExist:
+        # The whole thread has been removed, its listings were moved along with the root.
+        cache.set(listing_key(), version, None)
+        return
+
+    keys = [listing_key(), listing_key(post_type=root.type)]
+    keys += [listing_key(tag=tag) for tag in set(root.parse_tags()) | set(tags)]
+    if root.uid:
+        keys.append(f"{const.THREAD_VERSION_KEY}-{root.uid}")
+
+    cache.set_many(dict.fromkeys(keys, version), None)
+
+
 def delete_post_cache(post):
     """
     Drops both post specific template fragment caches.
@@ -78,6 +144,9 @@ def delete_post_cache(post):
         delete_fragment_cache("post", True, post.root.uid)
         delete_fragment_cache("post", False, post.root.uid)
 
+    # Any change to a post changes its thread.
+    bump_thread(post)
+
 
 class Post(models.Model):
     "Represents a post in a forum"
@@ -186,6 +255,9 @@ class Post(models.Model):
     # This is the  HTML that gets displayed.
     html = models.TextField(default='')
 
+    # Digest of the content, its links and the renderer the html was made from, see markdown.digest.
+    content_hash = models.CharField(max_length=64, default='', blank=True)
+
     # The tag value is the canonical form of the post's tags
     tag_val = models.CharField(max_length=100, default="", blank=True)
 
@@ -201,8 +273,16 @@ class Post(models.Model):
     # This post has been indexed by the search engine.
     has_diff = models.BooleanField(default=False)
 
+    # The post and its root are open and not spam, see set_visible.
+    visible = models.BooleanField(default=False)
+
     objects = PostManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['visible', 'is_toplevel', 'rank'], name='forum_post_visible_idx'),
+        ]
+
     def parse_tags(self):
         return [tag.lower() for tag in self.tag_val.split(",") if tag]
 
@@ -329,8 +409,15 @@ class Post(models.Model):
         self.creation_date = self.creation_date or util.now()
         self.lastedit_date = self.lastedit_date or util.now()
 
-        # Sanitize the post body.
-        self.html = markdown.parse(self.content, post=self, clean=True, escape=False)
+        # Sanitize the post body, unchanged content and links keep their html.
+        refs = markdown.resolve(self.content)
+        digest = markdown.digest(self.content, refs=refs, clean=True, escape=False)
+        if not (self.html and digest == self.content_hash):
+            self.html = markdown.parse(self.content, clean=True, escape=False, refs=refs)
+            self.content_hash = digest
+
+        # Embeds not stored yet are fetched after saving, see signals.finalize_post.
+        self.missing_embeds = markdown.embed_urls(self.content) - set(refs["embeds"])
         self.tag_val = self.tag_val.replace(' ', '')
         # Default tags
         self.tag_val = self.tag_val or "tag1,tag2"
@@ -346,26 +433,52 @@ class Post(models.Model):
     def __str__(self):
         return "%s: %s (pk=%s)" % (self.get_type_display(), self.title, self.pk)
 
-    def update_parent_counts(self):
+    def update_parent_counts(self, delta=0):
         """
         Update the counts for the parent and root
+
+        With a delta the counts are shifted by delta for this post alone,
+        otherwise they are recomputed with one aggregate query per level.
         """
 
+        if delta:
+            self.shift_parent_counts(delta)
+            return
+
         descendants = Post.objects.filter(root=self.root).exclude(Q(pk=self.root.pk) | Q(status=Post.DELETED)
                                                                   | Q(spam=Post.SPAM))
-        answer_count = descendants.filter(type=Post.ANSWER).count()
-        comment_count = descendants.filter(type=Post.COMMENT).count()
-        reply_count = descendants.count()
+        counts = descendants.aggregate(reply_count=Count('id'),
+                                       answer_count=Count('id', filter=Q(type=Post.ANSWER)),
+                                       comment_count=Count('id', filter=Q(type=Post.COMMENT)))
         # Update the root reply, answer, and comment counts.
-        Post.objects.filter(pk=self.root.pk).update(reply_count=reply_count, answer_count=answer_count,
-                                                    comment_count=comment_count)
+        Post.objects.filter(pk=self.root.pk).update(**counts)
 
         children = Post.objects.filter(parent=self.parent).exclude(pk=self.parent.pk)
-        com_count = children.filter(type=Post.COMMENT).count()
+        counts = children.aggregate(reply_count=Count('id'),
+                                    comment_count=Count('id', filter=Q(type=Post.COMMENT)))
 
         # Update parent reply, answer, and comment counts.
-        Post.objects.filter(pk=self.parent.pk, is_toplevel=False).update(comment_count=com_count, answer_count=0,
-                                                                         reply_count=children.count())
+        Post.objects.filter(pk=self.parent.pk, is_toplevel=False).update(answer_count=0, **counts)
+
+    def shift_parent_counts(self, delta):
+        """
+        Adds delta to the root and parent counts that include this post, in one transaction.
+        """
+
+        # Root counts leave out deleted and spam posts.
+        counted = self.status != Post.DELETED and self.spam != Post.SPAM
+        answer = delta if self.type == Post.ANSWER else 0
+        comment = delta if self.type == Post.COMMENT else 0
+
+        with transaction.atomic():
+            if counted and self.root_id != self.id:
+                Post.objects.filter(pk=self.root_id).update(reply_count=F('reply_count') + delta,
+                                                            answer_count=F('answer_count') + answer,
+                                                            comment_count=F('comment_count') + comment)
+
+            if self.parent_id != self.id:
+                Post.objects.filter(pk=self.parent_id, is_toplevel=False).update(
+                    reply_count=F('reply_count') + delta, comment_count=F('comment_count') + comment)
 
     @property
     def css(self):
@@ -391,6 +504,63 @@ class Post(models.Model):
         return delta.days
 
 
+def user_fields(name):
+    """
+    Columns of the user and profile shown next to a post: the link, the name and the icon.
+    """
+    return [f"{name}__is_staff", f"{name}__is_superuser", f"{name}__profile__user", f"{name}__profile__uid",
+            f"{name}__profile__name", f"{name}__profile__role", f"{name}__profile__state",
+            f"{name}__profile__score"]
+
+
+# Columns of the post lists, including every sort key, the text of the posts and profiles is left out.
+LIST_FIELDS = ['uid', 'title', 'type', 'status', 'spam', 'is_toplevel', 'tag_val', 'root', 'parent',
+               'author', 'lastedit_user', 'rank', 'creation_date', 'lastedit_date', 'vote_count',
+               'thread_votecount', 'reply_count', 'answer_count', 'accept_count', 'comment_count',
+               'view_count', 'book_count', 'subs_count',
+               'root__uid', 'root__type', 'root__view_count', 'root__answer_count', 'root__accept_count',
+               ] + user_fields('author') + user_fields('lastedit_user')
+
+
+def post_listing(query):
+    """
+    Narrows a post query to the columns shown in the post lists.
+    """
+    query = query.select_related("root", "author__profile", "lastedit_user__profile")
+    return query.only(*LIST_FIELDS)
+
+
+# Posts shown to everyone: open and not spam, in a thread that is open and not spam.
+SHOWN = Q(parent__isnull=False, status=Post.OPEN, spam__in=(Post.NOT_SPAM, Post.DEFAULT),
+          root__status=Post.OPEN, root__spam__in=(Post.NOT_SPAM, Post.DEFAULT))
+
+
+def set_visible(query):
+    """
+    Recomputes the visible flag of the posts in the query from their own and their root's state.
+
+    Only the flags that differ are written.
+    """
+    shown = query.filter(SHOWN).values('pk')
+    with transaction.atomic():
+        query.filter(pk__in=shown, visible=False).update(visible=True)
+        query.filter(visible=True).exclude(pk__in=shown).update(visible=False)
+
+
+def update_visibility(post):
+    """
+    Updates the visible flag of a post, the replies follow a top level post.
+    """
+    if post.is_toplevel:
+        query = Post.objects.filter(root_id=post.id)
+    else:
+        query = Post.objects.filter(id=post.id)
+    set_visible(query)
+
+    # The cached thread may list posts that are now hidden.
+    bump_thread(post)
+
+
 class Vote(models.Model):
     # Post statuses.
 
@@ -426,6 +596,71 @@ class PostView(models.Model):
     date = models.DateTimeField(auto_now_add=True)
 
 
+class ViewCounter:
+    """
+    Accumulates post views in memory and writes them in bulk.
+
+    Pending views are flushed once settings.POST_VIEW_BATCH views are buffered or
+    settings.POST_VIEW_FLUSH seconds have passed, with a single UPDATE for all view counts
+    and a single insert of the PostView rows. The buffers of idle workers are flushed
+    by the tasks.flush_post_views timer.
+
+    Views still buffered when a process is killed without running atexit (SIGKILL, harakiri)
+    are lost: at most POST_VIEW_BATCH views or POST_VIEW_FLUSH seconds of views per process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # View count increments keyed by post id.
+        self.counts = defaultdict(int)
+        # PostView rows waiting to be inserted.
+        self.views = []
+        self.flushed = time.time()
+
+    def tick(self):
+        """
+        Flushes the views that have waited too long, returns True when it did.
+        """
+        if self.views and time.time() - self.flushed >= settings.POST_VIEW_FLUSH:
+            self.flush()
+            return True
+        return False
+
+    def add(self, post_id, ip):
+        with self.lock:
+            self.counts[post_id] += 1
+            self.views.append(PostView(ip=ip, post_id=post_id))
+            due = len(self.views) >= settings.POST_VIEW_BATCH
+            due = due or time.time() - self.flushed >= settings.POST_VIEW_FLUSH
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            counts, views = self.counts, self.views
+            self.counts, self.views, self.flushed = defaultdict(int), [], time.time()
+
+        if not counts:
+            return
+
+        try:
+            # One statement updates every post, no matter how many were viewed.
+            whens = [When(id=pid, then=F('view_count') + incr) for pid, incr in counts.items()]
+            Post.objects.filter(id__in=counts).update(view_count=Case(*whens, default=F('view_count')))
+
+            # Posts deleted in the meantime are skipped.
+            existing = set(Post.objects.filter(id__in=counts).values_list('id', flat=True))
+            PostView.objects.bulk_create([view for view in views if view.post_id in existing])
+        except Exception as exc:
+            logger.error(f"Error writing {len(views)} post views: {exc}")
+
+
+# One view counter per process, flushed on exit.
+VIEWS = ViewCounter()
+atexit.register(lambda: VIEWS.flush())
+
+
 def update_post_views(post, request, timeout=settings.POST_VIEW_TIMEOUT):
     """
     Views are updated per interval.
@@ -441,18 +676,11 @@ def update_post_views(post, request, timeout=settings.POST_VIEW_TIMEOUT):
     if cache.get(cache_key):
         return
 
-    # Insert a new view into database.
-    PostView.objects.create(ip=ip, post=post)
-
-    # Separately increment post view.
-    Post.objects.filter(id=post.id).update(view_count=F('view_count') + 1)
-
     # Set the cache.
     cache.set(cache_key, 1, timeout)
 
-    # Drop the post related cache for logged in users.
-    if request.user.is_authenticated:
-        delete_post_cache(post)
+    # The view is written later, together with other views.
+    VIEWS.add(post_id=post.id, ip=ip)
 
     return post
 
@@ -703,3 +931,50 @@ class Log(models.Model):
         self.date = self.date or util.now()
         super(Log, self).save(*args, **kwargs)
 
+
+class Rendered(models.Model):
+    """
+    Markdown rendered into html, shared between processes when settings.MARKDOWN_CACHE_TABLE is on.
+    """
+
+    # Digest of the markdown, the render options and the renderer version.
+    digest = models.CharField(max_length=64, unique=True)
+
+    html = models.TextField(default='')
+
+    date = models.DateTimeField(auto_now_add=True)
+
+class Embed(models.Model):
+    """
+    Html embedded in place of a link, fetched in the background by tasks.expand_embeds.
+    """
+
+    # The canonical url of the embedded link, see markdown.embed_urls.
+    url = models.CharField(max_length=MAX_NAME_LEN, unique=True)
+
+    html = models.TextField(default='')
+
+    date = models.DateTimeField(auto_now=True)
+
+
+class Similar(models.Model):
+    """
+    Posts similar to a toplevel post, computed offline from the search index.
+    """
+
+    # The post the similar posts were computed for.
+    post = models.OneToOneField(Post, related_name="similar", on_delete=models.CASCADE)
+
+    # Comma separated uids of the similar posts, most similar first.
+    uids = models.TextField(default='')
+
+    # Date the similar posts were computed.
+    date = models.DateTimeField(db_index=True)
+
+    def save(self, *args, **kwargs):
+        self.date = self.date or util.now()
+        super(Similar, self).save(*args, **kwargs)
+
+    @property
+    def uid_list(self):
+        return [uid for uid in self.uids.split(',') if uid]
@@ -13,10 +13,11 @@ from django.contrib import messages
 from django.shortcuts import redirect, render
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
+from django.db import transaction
 from biostar.accounts.views import user_moderate as account_moderate
 from biostar.accounts.models import Profile, User
 from biostar.utils.decorators import check_params
-from biostar.forum.models import Post, delete_post_cache, Log
+from biostar.forum.models import Post, delete_post_cache, bump_thread, update_visibility, Log
 from biostar.forum import auth, const, util
 
 
@@ -170,12 +171,20 @@ def delete_post(request, post, **kwargs):
         msg = f"removed post"
         messages.info(request, mark_safe(msg))
         auth.db_logger(user=user, post=post, text=msg)
-        post.delete()
+
+        # Removed posts have no replies, they only need to be taken out of the counts.
+        with transaction.atomic():
+            if not post.is_toplevel:
+                post.update_parent_counts(delta=-1)
+            post.delete()
+
         # Deleted children should return root url.
         url = "/" if post.is_toplevel else post.root.get_absolute_url()
     else:
         Post.objects.filter(uid=post.uid).update(status=Post.DELETED)
+        update_visibility(post)
         post.recompute_scores()
+        post.update_parent_counts()
         msg = f"deleted post"
         messages.info(request, mark_safe(msg))
         auth.db_logger(user=user, post=post, text=msg)
@@ -194,6 +203,7 @@ def open(request, post, **kwargs):
 
     user = request.user
     Post.objects.filter(uid=post.uid).update(status=Post.OPEN, spam=Post.NOT_SPAM)
+    update_visibility(post)
     post.recompute_scores()
 
     post.root.recompute_scores()
@@ -272,6 +282,7 @@ def toggle_spam(request, post, **kwargs):
 
     # Refetch up to date state of the post.
     post = Post.objects.filter(id=post.id).get()
+    update_visibility(post)
 
     # Set the state for the user (only non moderators are affected)
     state = Profile.SUSPENDED if post.is_spam else Profile.NEW
@@ -285,8 +296,8 @@ def toggle_spam(request, post, **kwargs):
     else:
         text = f"restored post from spam"
 
-        # Set indexed flag to False, so it's removed from spam index
-        Post.objects.filter(id=post.id).update(indexed=False)
+    # The indexer removes spam from the search index and puts restored posts back.
+    Post.objects.filter(id=post.id).update(indexed=False)
 
     # Set a logging message.
     messages.success(request, text)
@@ -306,6 +317,7 @@ def close(request, post, **kwargs):
     """
     user = request.user
     Post.objects.filter(uid=post.uid).update(status=Post.CLOSED)
+    update_visibility(post)
     # Generate a rationale post on why this post is closed.
     rationale = mod_rationale(post=post, user=user,
                               template="messages/closed.md")
@@ -352,16 +364,20 @@ def relocate(request, post, **kwds):
         messages.warning(request, "cannot relocate a top level post")
         return url
 
-    if post.type == Post.COMMENT:
-        msg = f"relocated comment to answer"
-        post.type = Post.ANSWER
-    else:
-        msg = f"relocated answer to comment"
-        post.type = Post.COMMENT
+    with transaction.atomic():
+        # Take the post out of the counts of its current parent.
+        post.update_parent_counts(delta=-1)
 
-    post.parent = post.root
-    post.save()
-    post.update_parent_counts()
+        if post.type == Post.COMMENT:
+            msg = f"relocated comment to answer"
+            post.type = Post.ANSWER
+        else:
+            msg = f"relocated answer to comment"
+            post.type = Post.COMMENT
+
+        post.parent = post.root
+        post.save()
+        post.update_parent_counts(delta=1)
 
     auth.db_logger(user=request.user, post=post, text=f"{msg}")
     messages.info(request, msg)
@@ -384,6 +400,8 @@ def moderate(request, post, action):
     if action in action_map:
         mod_func = action_map[action]
         url = mod_func(request=request, post=post)
+        # Moderation changes the thread behind the cache.
+        bump_thread(post)
     else:
         url = post.get_absolute_url()
         msg = "Unknown moderation action given."
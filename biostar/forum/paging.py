@@ -0,0 +1,203 @@
+"""
+Pagination of the post listings.
+
+Offset pages get slower the deeper they are, the database reads and discards every row before them.
+The keyset paginator seeks to the last row of the previous page on the sort key and the id instead.
+Its links carry an opaque cursor token; page numbers are still accepted.
+"""
+import base64
+import json
+import logging
+from collections.abc import Sequence
+from datetime import datetime
+
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+logger = logging.getLogger('engine')
+
+# Cursor directions.
+AFTER, BEFORE = 'a', 'b'
+
+
+class CachedPaginator(Paginator):
+    """
+    Paginator that caches the count call.
+    """
+
+    # Time to live for the cache, in seconds
+    TTL = 300
+
+    def __init__(self, cache_key='', ttl=None, *args, **kwargs):
+        self.cache_key = cache_key
+
+        # May not contain spaces
+        self.cache_key = ''.join(self.cache_key.split())
+
+        self.ttl = self.TTL
+
+        super(CachedPaginator, self).__init__(*args, **kwargs)
+
+    @property
+    def count(self):
+
+        if self.cache_key:
+            # See if it is access the cache
+            value = cache.get(self.cache_key)
+            if value is None:
+                value = super(CachedPaginator, self).count
+                # logger.debug(f'setting the cache for "{self.cache_key}"')
+                cache.set(self.cache_key, value, self.ttl)
+        else:
+            value = super(CachedPaginator, self).count
+
+        return value
+
+
+class KeysetPage(Sequence):
+    """
+    A page of a keyset paginator, used in templates like a Django page.
+    """
+
+    def __init__(self, object_list, number, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __repr__(self):
+        return f"<Page {self.number} of {self.paginator.num_pages}>"
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return max(self.number - 1, 1)
+
+    @property
+    def next_cursor(self):
+        if self.has_next():
+            return self.paginator.make_cursor(AFTER, self.object_list[-1], self.number + 1)
+        return ''
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous():
+            return self.paginator.make_cursor(BEFORE, self.object_list[0], self.number - 1)
+        return ''
+
+
+class KeysetPaginator(CachedPaginator):
+    """
+    Pages a queryset on (order, id) with cursors, the count is cached and only used for display.
+
+    Orders on fields the cursor can not hold, annotations or related fields, are paged by offset.
+    """
+
+    def __init__(self, object_list, per_page, order='-rank', *args, **kwargs):
+        self.field = order.lstrip('-')
+        self.desc = order.startswith('-')
+
+        # The id breaks ties between equal sort keys.
+        tiebreak = '-pk' if self.desc else 'pk'
+        object_list = object_list.order_by(order, tiebreak)
+
+        super(KeysetPaginator, self).__init__(object_list=object_list, per_page=per_page, *args, **kwargs)
+
+    @property
+    def model_field(self):
+        try:
+            field = self.object_list.model._meta.get_field(self.field)
+        except FieldDoesNotExist:
+            return None
+        return None if (field.is_relation or field.null) else field
+
+    def make_cursor(self, direction, obj, number):
+        if not self.model_field:
+            return ''
+        value = getattr(obj, self.field)
+        # The JSON encoder cuts datetimes to milliseconds, the seek needs the exact value.
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        data = json.dumps([direction, value, obj.pk, number], cls=DjangoJSONEncoder)
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    def parse_cursor(self, cursor):
+        """
+        Returns the direction, sort key, id and page number of a cursor, None for invalid cursors.
+        """
+        field = self.model_field
+        if not (cursor and field):
+            return None
+        try:
+            data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            direction, value, pk, number = json.loads(data)
+            value = field.to_python(value)
+            pk, number = int(pk), max(int(number), 1)
+        except Exception as exc:
+            logger.warning(f"invalid page cursor: {exc}")
+            return None
+
+        if direction not in (AFTER, BEFORE):
+            return None
+        return direction, value, pk, number
+
+    def seek(self, direction, value, pk):
+        """
+        Returns the rows after or before the given key in the order of the page.
+        """
+        forward = (direction == AFTER) == self.desc
+        op = 'lt' if forward else 'gt'
+        cond = Q(**{f"{self.field}__{op}": value}) | Q(**{self.field: value, f"pk__{op}": pk})
+        query = self.object_list.filter(cond)
+
+        if direction == BEFORE:
+            query = query.reverse()
+        return query
+
+    def get_page(self, number=1, cursor=''):
+        """
+        Returns the page at the cursor, or at the page number when there is no valid cursor.
+        """
+        size = self.per_page
+        token = self.parse_cursor(cursor)
+
+        if token:
+            direction, value, pk, number = token
+            rows = list(self.seek(direction, value, pk)[:size + 1])
+            more = len(rows) > size
+            rows = rows[:size]
+            if direction == AFTER:
+                return KeysetPage(rows, number, self, has_next=more, has_previous=True)
+            return KeysetPage(rows[::-1], number, self, has_next=True, has_previous=more)
+
+        # The first page and old page links start at an offset.
+        try:
+            number = self.validate_number(number)
+        except PageNotAnInteger:
+            number = 1
+        except EmptyPage:
+            number = self.num_pages
+
+        bottom = (number - 1) * size
+        rows = list(self.object_list[bottom:bottom + size + 1])
+        return KeysetPage(rows[:size], number, self, has_next=len(rows) > size, has_previous=number > 1)
@@ -0,0 +1,180 @@
+"""
+Full text search backed by the search_vector column of PostgreSQL.
+
+The column and its GIN index are created by migration 0024 and kept up to date by a trigger
+on every insert or update of a post, so there is no index to build or share between nodes.
+Selected with SEARCH_BACKEND = 'postgres'.
+
+Experimental: the trigger and the queries are not covered by the test suite, which runs on sqlite.
+
+The index watcher (index --watch) only applies to the whoosh index, the trigger does its work here.
+"""
+import logging
+from functools import reduce
+from html import escape
+from operator import or_
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchHeadline, SearchVectorField
+from django.core.paginator import Paginator
+from django.db.models.expressions import RawSQL
+
+from biostar.forum import util
+from biostar.forum.models import Post, Similar
+from biostar.forum.search import LazyHit, ResultsInfo, normalize, save_similar
+
+logger = logging.getLogger('engine')
+
+# Text search configuration, must match the one used by the trigger.
+CONFIG = 'english'
+
+# The tsvector column maintained by the trigger.
+VECTOR = RawSQL('"forum_post"."search_vector"', [], output_field=SearchVectorField())
+
+# Markers placed around matches by ts_headline, replaced with tags once the text is escaped.
+START, STOP = '\x02', '\x03'
+
+
+def make_query(text):
+    """
+    Matches any of the words, eg. 'foo bar' == 'foo OR bar', like the whoosh parser.
+    """
+    words = normalize(text).split()
+    return reduce(or_, [SearchQuery(word, config=CONFIG) for word in words])
+
+
+def mark(text):
+    """
+    Escapes the headline and turns the match markers into highlights.
+    """
+    text = escape(text or '')
+    return text.replace(START, '<strong class="match">').replace(STOP, '</strong>')
+
+
+def headline(field, query, **kwargs):
+    return SearchHeadline(field, query, config=CONFIG, start_sel=START, stop_sel=STOP,
+                          highlight_all=False, **kwargs)
+
+
+def matching(query):
+    """
+    Returns the valid top level posts matching a query, with their search_rank.
+    """
+    posts = Post.objects.valid_posts(is_toplevel=True).annotate(vector=VECTOR)
+    posts = posts.filter(vector=query).annotate(search_rank=SearchRank(VECTOR, query))
+    posts = posts.select_related('author__profile')
+    return posts
+
+
+def copy_hit(post, title=None, excerpt=None):
+    fields = dict(title=post.title,
+                  content=post.content,
+                  uid=post.uid,
+                  tags=post.tag_val,
+                  author=post.author.profile.name,
+                  lastedit_date=post.lastedit_date)
+    # The headlines are already escaped by mark.
+    marked = dict(title=title, content=excerpt)
+    return LazyHit(fields=fields, highlights={key: value for key, value in marked.items() if value})
+
+
+def perform_search(query, page=1, fields=None, reverse=False, sortedby=[], limit=None):
+    """
+    Searches title, tags and content, highlighted with ts_headline.
+
+    The fields are always the ones in the search vector.
+    """
+
+    limit = limit or settings.SEARCH_LIMIT
+    if not normalize(query):
+        return [], ResultsInfo(1, 0, limit, 0)
+
+    query = make_query(query)
+
+    posts = matching(query)
+
+    # Relevance unless sorted by a field.
+    order = [f"-{field}" if reverse else field for field in sortedby or []]
+    posts = posts.order_by(*order or ['-search_rank', '-lastedit_date'])
+
+    pages = Paginator(posts, limit)
+    current = pages.get_page(page)
+
+    # Only the current page is highlighted.
+    ids = [post.id for post in current]
+    marked = Post.objects.filter(id__in=ids).annotate(title_mark=headline('title', query, max_words=60),
+                                                      content_mark=headline('content', query, max_fragments=5))
+    marked = {post.id: post for post in marked.only('id')}
+
+    final = [copy_hit(post, title=mark(marked[post.id].title_mark), excerpt=mark(marked[post.id].content_mark))
+             for post in current]
+
+    return final, ResultsInfo(current.number, pages.num_pages, limit, pages.count)
+
+
+def more_like_this(uid, top=0, sortedby=[]):
+    """
+    Return posts whose search vector matches any word from the title and tags of the given post.
+    """
+
+    top = top or settings.SIMILAR_FEED_COUNT
+
+    post = Post.objects.filter(uid=uid).first()
+    if not post:
+        return []
+
+    text = ' '.join([post.title, post.tag_val.replace(',', ' ')])
+    if not normalize(text):
+        return []
+
+    posts = matching(make_query(text)).exclude(uid=uid)
+    posts = posts.order_by(*sortedby or ['-search_rank'])[:top]
+
+    return [copy_hit(post) for post in posts]
+
+
+def parallel_index(procs=4, size=1000, **kwargs):
+    """
+    The trigger keeps every post indexed, only the flags are updated.
+    """
+    return Post.objects.filter(is_toplevel=True).update(indexed=True)
+
+
+def compute_similar(posts, top=0):
+    """
+    Stores the posts matching the words of the title and tags of each post.
+    """
+    started = util.now()
+    rows = []
+    for post in posts:
+        uids = ','.join(hit.uid for hit in more_like_this(uid=post.uid, top=top))
+        rows.append(Similar(post=post, uids=uids, date=started))
+
+    save_similar(rows)
+
+    return len(rows)
+
+
+def index_posts(posts, ix=None, overwrite=False, add_func=None):
+    """
+    The trigger has already indexed the posts, only the flags are updated.
+    """
+    Post.objects.filter(id__in=posts.values('id')).update(indexed=True)
+
+
+def update_index(delete=(), reindex=(), ix=None):
+    """
+    Spam and closed posts are filtered out at query time, only the flags are updated.
+    """
+    Post.objects.filter(uid__in=set(delete) | set(reindex)).update(indexed=True)
+
+
+def queue_deletes(uids):
+    """
+    Deleted posts take their search vector with them.
+    """
+    return
+
+
+def remove_post(post, ix=None):
+    update_index(delete=[post.uid])
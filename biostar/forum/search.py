@@ -1,12 +1,22 @@
+import fcntl
+import hashlib
+import importlib
 import logging
+import multiprocessing
 import os
 import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
 from itertools import count, islice
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 # Postgres specific queries should go into separate module.
 from django.conf import settings
-from django.db.models import Q
+from django.core.cache import caches
+from django.db import connections, transaction
+from django.db.models import Q, Min, Max
+from django.utils.html import escape
 from whoosh import writing, classify
 from whoosh.analysis import StemmingAnalyzer, StopFilter
 from whoosh.writing import AsyncWriter, BufferedWriter
@@ -16,10 +26,12 @@ import bleach
 from whoosh.qparser import MultifieldParser, OrGroup
 from whoosh.analysis import STOP_WORDS
 from whoosh.index import create_in, open_dir, exists_in
-from whoosh.fields import ID, TEXT, KEYWORD, Schema, BOOLEAN, NUMERIC, DATETIME
+from whoosh.fields import ID, TEXT, KEYWORD, STORED, Schema, BOOLEAN, NUMERIC, DATETIME
+from whoosh.highlight import ContextFragmenter, HtmlFormatter, highlight
 
 from biostar.utils.helpers import htmltomarkdown
-from biostar.forum.models import Post
+from biostar.forum.models import Post, Similar
+from biostar.forum import util
 
 logger = logging.getLogger('engine')
 
@@ -31,6 +43,30 @@ STOP += [w for w in STOP_WORDS]
 STOP = set(STOP)
 
 
+# Modules implementing the search functions of each backend, None is the whoosh index in this module.
+BACKENDS = dict(whoosh=None, postgres='biostar.forum.pgsearch')
+
+
+def pluggable(func):
+    """
+    Calls the function of the same name in the backend selected by settings.SEARCH_BACKEND.
+    """
+
+    @wraps(func)
+    def inner(*args, **kwargs):
+        if settings.SEARCH_BACKEND not in BACKENDS:
+            raise Exception(f"Invalid search backend: {settings.SEARCH_BACKEND}")
+
+        name = BACKENDS[settings.SEARCH_BACKEND]
+        if name is None:
+            return func(*args, **kwargs)
+
+        module = importlib.import_module(name)
+        return getattr(module, func.__name__)(*args, **kwargs)
+
+    return inner
+
+
 def timer_func():
     """
     Prints progress on inserting elements.
@@ -54,43 +90,326 @@ def timer_func():
     return elapsed, progress
 
 
-def copy_hits(result, highlight=False):
+class SearcherPool:
+    """
+    Keeps one searcher open per index and hands out leases on it.
+
+    The searcher is refreshed when the index generation changes. A searcher
+    that is still leased out is never closed under the thread using it,
+    it is retired and closed once the last lease is returned.
+    """
+
+    # How often to log the pool counters, in leases.
+    REPORT_EVERY = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Open indices, searchers and their generation keyed by (dirname, indexname).
+        self.indexes = {}
+        self.searchers = {}
+        self.generations = {}
+        # Number of leases currently held on each searcher.
+        self.leases = defaultdict(int)
+        # Searchers replaced while leased, closed on their last release.
+        self.retired = set()
+        self.counts = defaultdict(int)
+
+    def _current(self, key):
+        """
+        Returns an up to date searcher for the key. Must be called with the lock held.
+        """
+        searcher = self.searchers.get(key)
+
+        if searcher is None:
+            # First request for this index in the process.
+            dirname, indexname = key
+            self.indexes[key] = init_index(dirname=dirname, indexname=indexname)
+
+        ix = self.indexes[key]
+        generation = ix.latest_generation()
+
+        if searcher is None:
+            self.counts['misses'] += 1
+            searcher = ix.searcher()
+
+        elif generation == self.generations[key]:
+            self.counts['hits'] += 1
+
+        elif not self.leases.get(searcher):
+            # Nobody else holds this searcher, reuse the unchanged segments.
+            self.counts['refreshes'] += 1
+            searcher = searcher.refresh()
+
+        else:
+            # Refreshing would close readers still in use by other threads.
+            self.counts['misses'] += 1
+            self.retired.add(searcher)
+            searcher = ix.searcher()
+
+        self.searchers[key] = searcher
+        self.generations[key] = generation
+        return searcher
+
+    def acquire(self, dirname=None, indexname=None):
+        key = (dirname or settings.INDEX_DIR, indexname or settings.INDEX_NAME)
+
+        with self.lock:
+            try:
+                searcher = self._current(key)
+            except Exception as exc:
+                # The index may have been removed from under us, start over.
+                logger.warning(f"reopening search index: {exc}")
+                self.searchers.pop(key, None)
+                self.indexes.pop(key, None)
+                searcher = self._current(key)
+
+            self.leases[searcher] += 1
+
+            total = sum(self.counts.values())
+            if total % self.REPORT_EVERY == 0:
+                logger.info(f"searcher pool {self.stats()}")
+
+        return searcher
+
+    def release(self, searcher):
+        with self.lock:
+            self.leases[searcher] -= 1
+            if self.leases[searcher] > 0:
+                return
+
+            del self.leases[searcher]
+
+            # Close searchers that have been replaced in the meantime.
+            if searcher in self.retired:
+                self.retired.discard(searcher)
+                searcher.close()
+
+    @contextmanager
+    def lease(self, dirname=None, indexname=None):
+        """
+        Lease a searcher for the duration of the block.
+        """
+        searcher = self.acquire(dirname=dirname, indexname=indexname)
+        try:
+            yield searcher
+        finally:
+            self.release(searcher)
+
+    def close(self, dirname=None, indexname=None):
+        """
+        Drops the searcher of an index that is no longer used, closing it once released.
+        """
+        key = (dirname or settings.INDEX_DIR, indexname or settings.INDEX_NAME)
+
+        with self.lock:
+            searcher = self.searchers.pop(key, None)
+            self.indexes.pop(key, None)
+            self.generations.pop(key, None)
+
+            if searcher is None:
+                return
+            if self.leases.get(searcher):
+                self.retired.add(searcher)
+            else:
+                searcher.close()
+
+    def stats(self):
+        return dict(hits=self.counts['hits'], misses=self.counts['misses'], refreshes=self.counts['refreshes'])
+
+
+# One searcher pool per process.
+SEARCHERS = SearcherPool()
+
+
+class ResultCache:
+    """
+    Caches search results keyed by the query and the index generation they were computed on.
+
+    Results from an older generation are never returned, so a commit to the index
+    invalidates every entry. Entries are kept in a bounded in-process LRU and,
+    when settings.SEARCH_CACHE_BACKEND names a Django cache, shared through that cache.
+    """
+
+    def __init__(self, size=None):
+        self.lock = threading.Lock()
+        self.size = size
+        self.entries = OrderedDict()
+        self.generation = None
+
+    def backend(self):
+        alias = settings.SEARCH_CACHE_BACKEND
+        return caches[alias] if alias else None
+
+    def make_key(self, key, generation):
+        digest = hashlib.md5(repr(key).encode("utf-8")).hexdigest()
+        return f"search-{generation}-{digest}"
+
+    def get(self, key, generation):
+        key = self.make_key(key, generation)
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        backend = self.backend()
+        return backend.get(key) if backend else None
+
+    def set(self, key, generation, value):
+        key = self.make_key(key, generation)
+        size = settings.SEARCH_CACHE_SIZE if self.size is None else self.size
+
+        with self.lock:
+            # Entries from older generations can not be hit anymore.
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+        backend = self.backend()
+        if backend:
+            backend.set(key, value, settings.SEARCH_CACHE_TTL)
+
+
+# One result cache per process.
+RESULTS = ResultCache()
+
+
+class ResultsInfo:
+    """
+    Paging information of a results page that does not hold on to the searcher.
+    """
+
+    def __init__(self, pagenum, pagecount, pagelen, total):
+        self.pagenum = pagenum
+        self.pagecount = pagecount
+        self.pagelen = pagelen
+        self.total = total
+
+    def is_last_page(self):
+        return self.pagecount == 0 or self.pagenum == self.pagecount
+
+
+def normalize(query):
+    """
+    Collapses whitespace so equivalent queries share a cache entry.
     """
-    Copy the items in results into a dict.
+    return ' '.join(query.split())
+
+
+class LazyHit:
     """
-    # Highlight title and content
+    Stored fields of a search hit that highlights the title, content and tags on first access.
+
+    Holds no reference to the searcher so it can be cached after the searcher is released.
+    """
+
+    def __init__(self, fields, words=None, highlights=None):
+        self.fields = fields
+        # Query words for each field, None when the hit is not highlighted.
+        self.words = words
+        # Html of the fields already highlighted, eg. by the database.
+        self.highlights = dict(highlights or {})
+        self.uid = fields.get('uid')
+        self.author = fields.get('author')
+        self.lastedit_date = fields.get('lastedit_date')
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def highlight(self, fieldname, text, top=3):
+        """
+        Returns the highlighted text of a field, computed once per hit.
+
+        The text is escaped when it is not highlighted, the formatter escapes the highlighted fragments.
+        """
+        if fieldname in self.highlights:
+            return self.highlights[fieldname]
+
+        words = (self.words or {}).get(fieldname)
+        if not words or not text:
+            return escape(text or '')
+
+        fragmenter = ContextFragmenter(maxchars=100, surround=100)
+        analyzer = SCHEMA[fieldname].analyzer
+        marked = highlight(text, words, analyzer, fragmenter, HtmlFormatter(), top=top, minscore=0)
+        self.highlights[fieldname] = marked or escape(text)
+
+        return self.highlights[fieldname]
+
+    @property
+    def title(self):
+        return self.highlight('title', self.fields.get('title'))
+
+    @property
+    def content(self):
+        # Highlight the short excerpt, indexes built before it existed only store the content.
+        text = self.fields.get('excerpt') or self.fields.get('content')
+        return self.highlight('content', text, top=5)
+
+    @property
+    def tags(self):
+        return self.highlight('tags', self.fields.get('tags'))
+
+
+def query_words(results, fieldnames=('title', 'content', 'tags')):
+    """
+    Returns the query words of each field, used to highlight hits after the searcher is released.
+    """
+    words = dict()
+    for fieldname in fieldnames:
+        field = results.searcher.schema[fieldname]
+        terms = results.query_terms(expand=True, fieldname=fieldname)
+        words[fieldname] = frozenset(field.from_bytes(term[1]) for term in terms)
+    return words
+
+
+def copy_hits(result, highlight=False, words=None):
+    """
+    Copy the stored fields of a result into a lazily highlighted hit.
+    """
+    fields = {key: result.get(key) for key in ('title', 'excerpt', 'uid', 'tags', 'author', 'lastedit_date')}
+
+    # Only fall back to the full content when the index has no excerpt.
+    if not fields['excerpt']:
+        fields['content'] = result.get('content')
+
     if highlight:
-        title = result.highlights("title", minscore=0) or result.get('title')
-        content = result.highlights("content", top=5, minscore=0) or result.get('content')
-        tags = result.highlights("tags", minscore=0) or result.get('tags')
-    else:
-        title = result.get('title')
-        content = result.get('content')
-        tags = result.get('tags')
+        words = words or query_words(result.results)
 
-    bunched = dict(title=title,
-                   content=content,
-                   uid=result.get('uid'),
-                   tags=tags,
-                   author=result.get('author'),
-                   lastedit_date=result.get('lastedit_date'))
-    return bunched
+    return LazyHit(fields=fields, words=words if highlight else None)
 
 
 def index_exists(dirname=settings.INDEX_DIR, indexname=settings.INDEX_NAME):
     return exists_in(dirname=dirname, indexname=indexname)
 
 
-def add_index(post, writer):
+def index_fields(post):
+    """
+    Returns the document fields stored in the index for a post.
+    """
     # Ensure the content is stripped of any html.
     content = htmltomarkdown(post.content)
 
-    writer.update_document(title=post.title,
-                           content=content,
-                           tags=post.tag_val,
-                           author=post.author.profile.name,
-                           uid=post.uid,
-                           lastedit_date=post.lastedit_date)
+    fields = dict(title=post.title,
+                  content=content,
+                  tags=post.tag_val,
+                  author=post.author.profile.name,
+                  excerpt=content[:settings.SEARCH_EXCERPT_LENGTH],
+                  uid=post.uid,
+                  lastedit_date=post.lastedit_date)
+    return fields
+
+
+def add_index(post, writer):
+    writer.update_document(**index_fields(post))
 
 
 def get_schema():
@@ -98,12 +417,17 @@ def get_schema():
     schema = Schema(title=TEXT(analyzer=analyzer, stored=True, sortable=True),
                     content=TEXT(analyzer=analyzer, stored=True, sortable=True),
                     tags=KEYWORD(commas=True, stored=True),
+                    excerpt=STORED,
                     author=TEXT(stored=True),
                     uid=ID(unique=True, stored=True),
                     lastedit_date=DATETIME(sortable=True, stored=True))
     return schema
 
 
+# Analyzers used to highlight hits outside of a searcher.
+SCHEMA = get_schema()
+
+
 def init_index(dirname=None, indexname=None, schema=None):
     # Initialize a new index or return an already existing one.
 
@@ -113,6 +437,14 @@ def init_index(dirname=None, indexname=None, schema=None):
 
     if exists_in(dirname=dirname, indexname=indexname):
         ix = open_dir(dirname=dirname, indexname=indexname)
+        # Indexes built with an older schema get the fields added since, eg. excerpt.
+        missing = [name for name in ix_scheme.names() if name not in ix.schema]
+        if missing:
+            writer = ix.writer()
+            for name in missing:
+                writer.add_field(name, ix_scheme[name])
+            writer.commit()
+            logger.info(f"Added fields to the index: {', '.join(missing)}")
     else:
         # Ensure index directory exists.
         os.makedirs(dirname, exist_ok=True)
@@ -143,6 +475,8 @@ def print_info(dirname=None, indexname=None):
     print(f"{total} total posts")
 
 
+@pluggable
+@pluggable
 def index_posts(posts, ix=None, overwrite=False, add_func=add_index):
     """
     Create or update a search index of posts.
@@ -172,6 +506,107 @@ def index_posts(posts, ix=None, overwrite=False, add_func=add_index):
     elapsed(f"Committed {total} posts to index.")
 
 
+def sync_index(writer, last=0, size=1000):
+    """
+    Applies un-indexed posts to the writer in id order, starting after the last id.
+    Open top level posts are added, every other post is removed from the index.
+
+    Returns the ids of the posts that were handled.
+    """
+
+    # Top level posts and spam are the only posts that touch the index.
+    posts = Post.objects.filter(indexed=False, id__gt=last).filter(Q(is_toplevel=True) | Q(spam=Post.SPAM))
+    posts = posts.select_related('author__profile').order_by('id')[:size]
+
+    ids = []
+    for post in posts:
+        if post.is_toplevel and post.is_open:
+            add_index(post=post, writer=writer)
+        else:
+            writer.delete_by_term('uid', post.uid)
+        ids.append(post.id)
+
+    return ids
+
+
+def index_range(bounds):
+    """
+    Returns the ids and the document fields of valid top level posts with ids in the [start, end) range.
+    Runs in the worker processes of a parallel reindex.
+    """
+    start, end = bounds
+    posts = Post.objects.valid_posts(is_toplevel=True, id__gte=start, id__lt=end)
+    posts = posts.select_related('author__profile').order_by('id')
+
+    ids, docs = [], []
+    for post in posts.iterator():
+        ids.append(post.id)
+        docs.append(index_fields(post))
+
+    return ids, docs
+
+
+@pluggable
+def parallel_index(procs=4, size=1000, dirname=None, indexname=None, limitmb=256):
+    """
+    Rebuilds the search index from scratch.
+
+    Posts are split into id ranges of the given size that are converted in procs worker processes.
+    The documents are written with a multi segment writer using procs processes.
+    """
+
+    dirname = dirname or settings.INDEX_DIR
+    indexname = indexname or settings.INDEX_NAME
+    elapsed, progress = timer_func()
+
+    # Posts edited after this point are left for the incremental indexer.
+    started = util.now()
+
+    bounds = Post.objects.aggregate(start=Min('id'), end=Max('id'))
+    start, end = bounds['start'] or 0, bounds['end'] or 0
+    ranges = [(lo, lo + size) for lo in range(start, end + 1, size)]
+
+    # Replace the existing index with an empty one.
+    os.makedirs(dirname, exist_ok=True)
+    ix = create_in(dirname=dirname, schema=get_schema(), indexname=indexname)
+
+    if procs > 1:
+        # Worker processes must not share the database connection of the parent.
+        connections.close_all()
+        pool = multiprocessing.Pool(procs)
+        stream = pool.imap_unordered(index_range, ranges)
+    else:
+        pool, stream = None, map(index_range, ranges)
+
+    writer = ix.writer(procs=procs, multisegment=True, limitmb=limitmb)
+
+    total, written = 0, []
+    try:
+        for step, (ids, docs) in zip(count(1), stream):
+            for fields in docs:
+                writer.add_document(**fields)
+            written.append(ids)
+            total += len(docs)
+            progress(step, step=10, total=len(ranges), msg=f"ranges converted, {total} posts")
+        writer.commit()
+    except Exception:
+        writer.cancel()
+        raise
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    # Only the written posts that are still valid and were not edited since the start are in their final state.
+    # Posts that changed during the rebuild are left for the incremental indexer.
+    for ids in written:
+        Post.objects.valid_posts(is_toplevel=True, id__in=ids, lastedit_date__lt=started).update(indexed=True)
+
+    elapsed(f"Reindexed {total} posts with {procs} processes")
+
+    return total
+
+
 def crawl(reindex=False, overwrite=False, limit=1000):
     """
     Crawl through posts in batches and add them to index.
@@ -197,20 +632,22 @@ def crawl(reindex=False, overwrite=False, limit=1000):
     return
 
 
-def whoosh_search(query, limit=10, page=1, ix=None, fields=None, reverse=False, sortedby=[], **kwargs):
+def whoosh_search(query, limit=10, page=1, ix=None, fields=None, reverse=False, sortedby=[], searcher=None,
+                  **kwargs):
     """
-    Query search index
+    Query search index.
+
+    Uses the given searcher, otherwise opens a new one that the caller has to close.
     """
 
     fields = fields or ['tags', 'title', 'content', 'author']
-    ix = ix or init_index()
-    searcher = ix.searcher()
+    searcher = searcher or (ix or init_index()).searcher()
 
     # Splits the query into words and applies
     # and OR filter, eg. 'foo bar' == 'foo OR bar'
     orgroup = OrGroup
 
-    parser = MultifieldParser(fieldnames=fields, schema=ix.schema, group=orgroup).parse(query)
+    parser = MultifieldParser(fieldnames=fields, schema=searcher.schema, group=orgroup).parse(query)
 
     hits = searcher.search_page(parser,pagenum=page, pagelen=limit, reverse=reverse, sortedby=sortedby, **kwargs)
     hits.results.fragmenter.maxchars = 100
@@ -219,25 +656,39 @@ def whoosh_search(query, limit=10, page=1, ix=None, fields=None, reverse=False,
     return hits
 
 
+@pluggable
 def perform_search(query, page=1, fields=None, reverse=False, sortedby=[], limit=None):
     """
-    Utility functions to search whoosh index, collect results and closes
+    Utility functions to search whoosh index, collect results and closes.
+
+    Results are cached until the index changes.
     """
 
     limit = limit or settings.SEARCH_LIMIT
+    key = (normalize(query), page, fields, reverse, sortedby, limit)
+
+    with SEARCHERS.lease() as searcher:
+        generation = searcher.reader().generation()
 
-    indexed = whoosh_search(query=query, fields=fields, page=page, reverse=reverse, sortedby=sortedby, limit=limit)
+        cached = RESULTS.get(key, generation)
+        if cached is not None:
+            return cached
 
-    # Highlight the whoosh results.
-    copier = lambda r: copy_hits(r, highlight=True)
+        indexed = whoosh_search(query=query, fields=fields, page=page, reverse=reverse, sortedby=sortedby,
+                                limit=limit, searcher=searcher)
 
-    final = list(map(copier, indexed))
+        # Highlights are computed when first shown, only for the top hits.
+        words = query_words(indexed.results)
+        first = settings.SEARCH_HIGHLIGHT_FIRST or len(indexed)
+        final = [copy_hits(r, highlight=index < first, words=words) for index, r in enumerate(indexed)]
 
-    indexed.results.searcher.close()
+    found = final, ResultsInfo(indexed.pagenum, indexed.pagecount, indexed.pagelen, indexed.total)
+    RESULTS.set(key, generation, found)
 
-    return final, indexed
+    return found
 
 
+@pluggable
 def more_like_this(uid, top=0, sortedby=[]):
     """
     Return posts in search index most similar to given post.
@@ -245,30 +696,139 @@ def more_like_this(uid, top=0, sortedby=[]):
 
     top = top or settings.SIMILAR_FEED_COUNT
     fields = ['uid']
-    found = whoosh_search(query=uid, sortedby=sortedby, fields=fields)
 
-    if len(found):
-        hits = found[0].more_like_this("content", top=top)
-        # Copy hits to list and close searcher object.
-        final = list(map(copy_hits, hits))
-    else:
-        final = []
+    with SEARCHERS.lease() as searcher:
+        found = whoosh_search(query=uid, sortedby=sortedby, fields=fields, searcher=searcher)
 
-    found.results.searcher.close()
+        if len(found):
+            hits = found[0].more_like_this("content", top=top)
+            # Copy hits to list while the searcher is leased.
+            final = list(map(copy_hits, hits))
+        else:
+            final = []
 
     return final
 
 
-def remove_post(post, ix=None):
+@pluggable
+def compute_similar(posts, top=0):
     """
-    Remove spam from index
+    Stores the posts most similar to each post, using a single searcher for the whole batch.
+
+    Posts missing from the index are skipped. Returns the number of posts updated.
     """
 
-    ix = ix or init_index()
+    top = top or settings.SIMILAR_FEED_COUNT
+    started = util.now()
+    rows = []
+
+    with SEARCHERS.lease() as searcher:
+        for post in posts:
+            docnum = searcher.document_number(uid=post.uid)
+            if docnum is None:
+                continue
+            hits = searcher.more_like(docnum, "content", top=top)
+            uids = ','.join(hit['uid'] for hit in hits)
+            rows.append(Similar(post=post, uids=uids, date=started))
+
+    save_similar(rows)
 
-    # Remove this post from index
+    return len(rows)
+
+
+def save_similar(rows):
+    """
+    Replaces the previous similar posts of the posts in the rows.
+
+    Readers see either the previous or the new rows, never none.
+    """
+    with transaction.atomic():
+        Similar.objects.filter(post__in=[row.post for row in rows]).delete()
+        Similar.objects.bulk_create(rows)
+
+
+@pluggable
+def update_index(delete=(), reindex=(), ix=None):
+    """
+    Deletes and reindexes posts by uid in a single writer with one commit.
+
+    Reindexed posts that are no longer open toplevel posts are deleted instead.
+    Does nothing when the index has not been built yet.
+    """
+
+    dirname, indexname = settings.INDEX_DIR, settings.INDEX_NAME
+    if not ix and not exists_in(dirname=dirname, indexname=indexname):
+        return
+
+    delete, reindex = set(delete), set(reindex)
+    if not (delete or reindex):
+        return
+
+    ix = ix or init_index()
     writer = AsyncWriter(ix)
-    writer.delete_by_term('uid', text=post.uid)
+
+    try:
+        posts = Post.objects.filter(uid__in=reindex).select_related('author__profile')
+        added = set()
+        for post in posts:
+            if post.is_toplevel and post.is_open:
+                add_index(post=post, writer=writer)
+                added.add(post.uid)
+
+        for uid in (delete | reindex) - added:
+            writer.delete_by_term('uid', uid)
+    except Exception:
+        writer.cancel()
+        raise
+
     writer.commit()
-    logger.debug(f"Removing uid={post.uid} from index")
-    return
+
+    # The index now reflects the current state of these posts.
+    Post.objects.filter(uid__in=delete | reindex).update(indexed=True)
+
+    logger.debug(f"Reindexed {len(added)} and removed {len((delete | reindex) - added)} posts from index")
+
+
+def queue_path():
+    return os.path.join(settings.INDEX_DIR, f"{settings.INDEX_NAME}-deletes.txt")
+
+
+@pluggable
+def queue_deletes(uids):
+    """
+    Queues the uids of posts deleted from the database, the index watcher removes them.
+    """
+    uids = list(uids)
+    if not uids:
+        return
+
+    os.makedirs(settings.INDEX_DIR, exist_ok=True)
+    with open(queue_path(), 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        fp.write(''.join(f"{uid}\n" for uid in uids))
+
+
+@contextmanager
+def queued_deletes():
+    """
+    Yields the queued uids, the queue is emptied when the block completes without errors.
+
+    The queue stays locked for the duration of the block.
+    """
+    fname = queue_path()
+    if not os.path.exists(fname):
+        yield []
+        return
+
+    with open(fname, 'r+') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        yield fp.read().split()
+        fp.truncate(0)
+
+
+@pluggable
+def remove_post(post, ix=None):
+    """
+    Remove spam from index
+    """
+    update_index(delete=[post.uid], ix=ix or init_index())
@@ -59,6 +59,31 @@ SEARCH_LIMIT = 50
 # Initialize the planet app.
 INIT_PLANET = False
 
+# Search backend: 'whoosh' keeps an index on disk, 'postgres' uses full text search in the database (needs psycopg2).
+# The postgres backend is experimental.
+SEARCH_BACKEND = 'whoosh'
+
+# Number of search result pages cached in each process, 0 turns the local cache off.
+SEARCH_CACHE_SIZE = 1000
+
+# Name of a cache in CACHES that shares search results between processes.
+SEARCH_CACHE_BACKEND = ''
+
+# How long search results stay in the shared cache (seconds).
+SEARCH_CACHE_TTL = 3600
+
+# Highlight only the first hits on a search page, 0 highlights every hit.
+SEARCH_HIGHLIGHT_FIRST = 10
+
+# Characters of the post content stored as the search excerpt.
+SEARCH_EXCERPT_LENGTH = 1000
+
+# Seconds between checks for a new autocomplete snapshot saved by the indexer.
+AUTOCOMPLETE_RELOAD = 10
+
+# Number of titles and tags suggested while typing a search.
+AUTOCOMPLETE_LIMIT = 10
+
 # Minimum amount of characters to preform searches
 SEARCH_CHAR_MIN = 1
 
@@ -148,6 +173,33 @@ WSGI_APPLICATION = 'biostar.wsgi.application'
 # Time between two accesses from the same IP to qualify as a different view (seconds)
 POST_VIEW_TIMEOUT = 300
 
+# How long the posts of a thread stay cached, a change in the thread replaces them sooner (seconds).
+THREAD_CACHE_TIMEOUT = 3600 * 24
+
+# How long pages stay cached for anonymous visitors, a change in the posts replaces them sooner (seconds).
+PAGE_CACHE_TIMEOUT = 300
+
+# Rendered markdown kept in each process, 0 turns the local cache off.
+MARKDOWN_CACHE_SIZE = 2000
+
+# Also store rendered markdown in the database, shared between processes and restarts.
+MARKDOWN_CACHE_TABLE = False
+
+# Markdown renders slower than this are logged with the time of each stage, 0 turns it off (seconds).
+MARKDOWN_SLOW_RENDER = 0.5
+
+# Function that fetches the html of an embedded link, it is given the url.
+EMBED_FETCHER = 'biostar.forum.markdown.fetch_oembed'
+
+# Longest wait for the html of an embedded link (seconds).
+EMBED_TIMEOUT = 5
+
+# Post views are buffered and written once this many are pending (views).
+POST_VIEW_BATCH = 100
+
+# Longest time a post view is buffered before it is written (seconds).
+POST_VIEW_FLUSH = 60
+
 # This flag is used flag situation where a data migration is in progress.
 # Allows us to turn off certain type of actions (for example sending emails).
 DATA_MIGRATION = False
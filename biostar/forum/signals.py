@@ -1,11 +1,13 @@
 import logging
 from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
+from django.db import transaction
 from taggit.models import Tag
 from django.db.models import F, Q
 from biostar.accounts.models import Profile, Message, User
-from biostar.forum.models import Post, Award, Subscription, SharedLink, Diff
-from biostar.forum import tasks, auth, util
+from biostar.forum.models import Post, Award, Subscription, SharedLink, Diff, bump_thread, set_visible, \
+    update_visibility
+from biostar.forum import tasks, auth, util, markdown, search
 
 
 logger = logging.getLogger("engine")
@@ -54,7 +56,12 @@ def ban_user(sender, instance, created, **kwargs):
     if instance.state == Profile.BANNED:
         # Delete all posts by this users
         #print(Post.objects.filter(author=instance.user).thread_users)
-        Post.objects.filter(author=instance.user).delete()
+        posts = Post.objects.filter(author=instance.user)
+        uids = list(posts.values_list('uid', flat=True))
+        posts.delete()
+
+        # Remove the deleted posts from the search index.
+        search.queue_deletes(uids)
         #print(Post.objects.filter(author=instance))
         # Remove all 'lastedit user' flags for this user.
         # posts = Post.objects.filter(lastedit_user=instance.user)
@@ -73,7 +80,18 @@ def ban_user(sender, instance, created, **kwargs):
 
     # Label all posts by a spammer as 'spam'
     if instance.is_spammer:
-        Post.objects.filter(author=instance.user).update(spam=Post.SPAM)
+        # Only posts not yet marked change, saving the profile again does nothing.
+        changed = Post.objects.filter(author=instance.user).exclude(spam=Post.SPAM)
+        roots = set(changed.values_list('root_id', flat=True))
+
+        # The indexer removes the spam from the search index.
+        if changed.update(spam=Post.SPAM, indexed=False):
+            # Hide the posts and the replies to them.
+            set_visible(Post.objects.filter(Q(author=instance.user) | Q(root__author=instance.user)))
+
+            # The cached threads may list the hidden posts.
+            for root in Post.objects.filter(id__in=roots):
+                bump_thread(root)
 
 
 @receiver(post_save, sender=Post)
@@ -116,9 +134,10 @@ def finalize_post(sender, instance, created, **kwargs):
         # Update this post rank on create and not every edit.
         instance.rank = instance.lastedit_date.timestamp()
 
-        # Save the instance.
-        instance.save()
-        instance.update_parent_counts()
+        # Save the instance and count it in the thread.
+        with transaction.atomic():
+            instance.save()
+            instance.update_parent_counts(delta=1)
 
         # Bump the root rank when a new answer is added.
         if instance.is_answer:
@@ -136,8 +155,17 @@ def finalize_post(sender, instance, created, **kwargs):
         # Send out mailing list when post is created.
         tasks.mailing_list.spool(uid=instance.uid, extra_context=extra_context)
 
-    # Set the tags on the instance.
+    # Subscribe the users mentioned in the post to the thread.
+    auth.create_subscriptions(post=instance, users=markdown.mentions(instance.content))
+
+    # Embeds are fetched in the background, the post shows plain links until then.
+    if getattr(instance, 'missing_embeds', None):
+        tasks.expand_embeds.spool(uid=instance.uid)
+
+    # Set the tags on the instance, the listings of the previous tags change too.
+    listed = []
     if instance.is_toplevel:
+        listed = list(instance.tags.names())
         tags = [Tag.objects.get_or_create(name=name)[0] for name in instance.parse_tags()]
         instance.tags.clear()
         instance.tags.add(*tags)
@@ -154,6 +182,12 @@ def finalize_post(sender, instance, created, **kwargs):
     # Ensure posts get re-indexed after being edited.
     Post.objects.filter(uid=instance.uid).update(indexed=False)
 
+    # Show or hide the post, and its replies when top level.
+    update_visibility(instance)
+
+    # Cached copies of the thread are out of date.
+    bump_thread(instance, tags=listed)
+
     # Exclude current authors from receiving messages from themselves
     subs = subs.exclude(Q(type=Subscription.NO_MESSAGES) | Q(user=instance.author))
 
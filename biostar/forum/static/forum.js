@@ -292,6 +292,27 @@ $(document).ready(function () {
 
     $('.ui.dropdown').dropdown();
 
+    // Suggest titles and tags while typing in the search bar.
+    $('.ui.search[data-autocomplete]').each(function () {
+        var elem = $(this);
+        elem.search({
+            minCharacters: 2,
+            showNoResults: false,
+            apiSettings: {
+                url: elem.data('autocomplete') + '?query={query}',
+                onResponse: function (data) {
+                    var posts = $.map(data.posts || [], function (post) {
+                        return {title: post.label, url: post.url};
+                    });
+                    var tags = $.map(data.tags || [], function (tag) {
+                        return {title: tag.label, description: tag.count + ' posts', url: tag.url};
+                    });
+                    return {results: tags.concat(posts)};
+                }
+            }
+        });
+    });
+
 
     $(this).on('keyup', 'textarea', function (event) {
         var text = $(this).val();
@@ -50,6 +50,16 @@ def notify_watched_tags(uid, extra_context):
                    mass=True)
 
 
+@timer(settings.POST_VIEW_FLUSH, target='workers')
+def flush_post_views(*args):
+    """
+    Writes the post views buffered by each idle worker.
+    """
+    from biostar.forum.models import VIEWS
+
+    VIEWS.tick()
+
+
 @task
 def created_post(pid):
     message(f"Created post={pid}")
@@ -213,9 +223,29 @@ def set_link_title(pk):
         logger.warning(exc)
 
 
+@task
+def expand_embeds(uid):
+    """
+    Fetches the embeds linked in a post and renders the post again with them.
+    """
+    from biostar.forum import markdown
+    from biostar.forum.models import Post, delete_post_cache
+
+    post = Post.objects.filter(uid=uid).first()
+    if not post or not markdown.fetch_embeds(post.content):
+        return
+
+    # The hash matches the new html, the next save does not render it again.
+    refs = markdown.resolve(post.content)
+    html = markdown.parse(post.content, clean=True, escape=False, refs=refs)
+    content_hash = markdown.digest(post.content, refs=refs, clean=True, escape=False)
+    Post.objects.filter(pk=post.pk).update(html=html, content_hash=content_hash)
+    delete_post_cache(post)
+
+
 @task
 def spam_check(uid):
-    from biostar.forum.models import Post, Log, delete_post_cache
+    from biostar.forum.models import Post, Log, delete_post_cache, update_visibility
     from biostar.accounts.models import User, Profile
     from biostar.forum.auth import db_logger
 
@@ -266,6 +296,7 @@ def spam_check(uid):
         if flag:
 
             Post.objects.filter(uid=post.uid).update(spam=Post.SPAM, status=Post.CLOSED)
+            update_visibility(post)
 
             # Get the first admin.
             user = User.objects.filter(is_superuser=True).order_by("pk").first()
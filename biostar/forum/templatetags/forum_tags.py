@@ -10,8 +10,7 @@ import bleach
 from django import template, forms
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.paginator import Paginator
-from django.db.models import Count
+from django.db.models import Count, Prefetch
 from django.shortcuts import reverse
 from django.utils.safestring import mark_safe
 from django.utils.timezone import utc
@@ -23,7 +22,8 @@ from biostar.accounts.models import Profile, Message
 from biostar.forum import const, auth
 from biostar.utils import helpers
 from biostar.forum import markdown
-from biostar.forum.models import Post, Vote, Award, Subscription, Badge
+from biostar.forum.models import Post, Vote, Award, Subscription, Badge, post_listing, user_fields
+from biostar.forum.paging import KeysetPaginator
 
 User = get_user_model()
 
@@ -442,7 +442,9 @@ def search_bar(context, tags=False, users=False):
     search_url = reverse('tags_list') if tags else reverse('community_list') if users else reverse('post_search')
     request = context['request']
     value = request.GET.get('query', '')
-    context = dict(search_url=search_url, value=value)
+    # Only the post search offers type-ahead suggestions.
+    autocomplete_url = '' if (tags or users) else reverse('search_autocomplete')
+    context = dict(search_url=search_url, value=value, autocomplete_url=autocomplete_url)
 
     return context
 
@@ -454,6 +456,7 @@ def get_post_list(target, request, show=None):
     """
     user = request.user
     page = request.GET.get("page", 1)
+    cursor = request.GET.get("cursor", "")
     posts = Post.objects.valid_posts(u=user, author=target)
 
     # Show a specific post listing.
@@ -464,12 +467,16 @@ def get_post_list(target, request, show=None):
     type_filter = show_map.get(show)
     posts = posts.filter(type=type_filter) if type_filter is not None else posts
 
-    posts = posts.select_related("root").select_related("author__profile", "lastedit_user__profile")
-    posts = posts.order_by("-rank")
+    posts = post_listing(posts)
 
-    # Cache the users posts add pagination to posts.
-    paginator = Paginator(object_list=posts, per_page=settings.POSTS_PER_PAGE)
-    posts = paginator.get_page(page)
+    # Cache the count of the users posts, moderators see more of them.
+    moderator = user.is_authenticated and user.profile.is_moderator
+    cache_key = f"{const.USER_POSTS_KEY}-{target.id}-{show}-{int(moderator)}"
+
+    # Seek on rank to page through prolific users.
+    paginator = KeysetPaginator(object_list=posts, per_page=settings.POSTS_PER_PAGE, order='-rank',
+                                cache_key=cache_key)
+    posts = paginator.get_page(page, cursor=cursor)
 
     return posts
 
@@ -492,8 +499,10 @@ def awards_feed():
 
 @register.inclusion_tag('widgets/feed_default.html')
 def default_feed(user):
+    # Only the titles of the voted posts are shown.
+    voted = Prefetch("post", queryset=Post.objects.only("uid", "title"))
     recent_votes = Vote.objects.filter(post__status=Post.OPEN,
-                                       post__root__status=Post.OPEN).prefetch_related("post")
+                                       post__root__status=Post.OPEN).prefetch_related(voted)
     recent_votes = recent_votes.order_by("-pk")[:settings.VOTE_FEED_COUNT]
 
     # Get valid users that have a location set in profile.
@@ -504,7 +513,8 @@ def default_feed(user):
     recent_awards = awards_feed()
 
     # Get valid posts
-    recent_replies = Post.objects.valid_posts(is_toplevel=False).select_related("author__profile", "author")
+    recent_replies = Post.objects.valid_posts(is_toplevel=False).select_related("author__profile")
+    recent_replies = recent_replies.only("uid", "title", "content", "author", *user_fields("author"))
     recent_replies = recent_replies.order_by("-pk")[:settings.REPLIES_FEED_COUNT]
 
     context = dict(recent_votes=recent_votes, recent_awards=recent_awards,
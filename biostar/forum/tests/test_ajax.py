@@ -1,11 +1,14 @@
 import logging
 import json
+import time
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.test import TestCase
 from django.urls import reverse
 from unittest.mock import patch, MagicMock
 from biostar.accounts.models import User, Profile
 
-from biostar.forum import models, views, auth, forms, const, ajax
+from biostar.forum import models, views, auth, forms, const, ajax, util
 from biostar.utils.helpers import fake_request
 from biostar.forum.util import get_uuid
 
@@ -54,6 +57,41 @@ class PostTest(TestCase):
         self.preform_votes(post=self.post, user=self.owner)
         self.preform_votes(post=self.post, user=user2)
 
+    def test_vote_counts(self):
+        """
+        Test that applying a vote runs the same queries no matter how many votes a post has.
+        """
+        answer = models.Post.objects.create(title="answer", author=self.owner, content="tested foo bar too for",
+                                            type=models.Post.ANSWER, parent=self.post)
+        voters = [User.objects.create(username=f"voter{i}", email=f"voter{i}@tested.com") for i in range(201)]
+
+        def timed(user):
+            start = time.perf_counter()
+            with self.assertNumQueries(queries):
+                auth.apply_vote(post=answer, user=user, vote_type=models.Vote.UP)
+            return time.perf_counter() - start
+
+        # Queries used on a post without votes.
+        with CaptureQueriesContext(connection) as context:
+            auth.apply_vote(post=answer, user=voters[0], vote_type=models.Vote.UP)
+        queries = len(context.captured_queries)
+
+        first = timed(voters[1])
+        models.Vote.objects.bulk_create([models.Vote(author=user, post=answer, type=models.Vote.UP, date=util.now())
+                                         for user in voters[2:-1]])
+        last = timed(voters[-1])
+        logger.info(f"apply_vote with 2 votes: {first * 1000:.2f}ms, with 200 votes: {last * 1000:.2f}ms")
+
+        answer = models.Post.objects.get(id=answer.id)
+        root = models.Post.objects.get(id=self.post.id)
+        self.assertEqual(answer.vote_count, 201)
+        self.assertEqual(root.thread_votecount, 3)
+
+        # Accepting an answer counts on the answer and on its thread.
+        auth.apply_vote(post=answer, user=self.owner, vote_type=models.Vote.ACCEPT)
+        self.assertEqual(models.Post.objects.get(id=answer.id).accept_count, 1)
+        self.assertEqual(models.Post.objects.get(id=self.post.id).accept_count, 1)
+
     def test_drag_and_drop(self):
         """
         Test AJAX function used to drag and drop.
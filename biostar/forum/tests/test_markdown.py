@@ -1,6 +1,8 @@
+import json
 import logging
 import os
-from django.test import TestCase
+from unittest import mock
+from django.test import TestCase, override_settings
 from django.conf import settings
 from biostar.forum import models, markdown
 from biostar.accounts.models import User
@@ -11,6 +13,19 @@ PORT = ':' + settings.HTTP_PORT if settings.HTTP_PORT else ''
 SITE_URL = f"{settings.SITE_DOMAIN}{PORT}"
 
 
+TWEET = "https://twitter.com/Linux/status/2311234267"
+
+TWEET_HTML = '<blockquote class="twitter-tweet"><p lang="en" dir="ltr">w00t! 10,000 followers!</p>&mdash; Linux (@Linux) <a href="https://twitter.com/Linux/status/2311234267?ref_src=twsrc%5Etfw">June 24, 2009</a></blockquote><script async src="https://platform.twitter.com/widgets.js" charset="utf-8"></script>'
+
+
+def fetch_stub(url):
+    "Answers embed requests without the network."
+    return TWEET_HTML
+
+
+def fetch_error(url):
+    raise IOError("network is down")
+
 
 TEST_CASES = [
 
@@ -24,7 +39,7 @@ TEST_CASES = [
     (f"{settings.PROTOCOL}://{SITE_URL}/u/5 ", f'<p><a href="{settings.PROTOCOL}://{SITE_URL}/u/5" rel="nofollow">tested2</a></p>'),
 
     # Twitter link
-    ("https://twitter.com/Linux/status/2311234267", '<p><blockquote class="twitter-tweet"><p lang="en" dir="ltr">w00t! 10,000 followers!</p>&mdash; Linux (@Linux) <a href="https://twitter.com/Linux/status/2311234267?ref_src=twsrc%5Etfw">June 24, 2009</a></blockquote><script async src="https://platform.twitter.com/widgets.js" charset="utf-8"></script></p>'),
+    ("https://twitter.com/Linux/status/2311234267", f'<p>{TWEET_HTML}</p>'),
 
     # Youtube link
     ("https://www.youtube.com/watch?v=dQw4w9WgXcQ", '<p><iframe width="420" height="315" src="//www.youtube.com/embed/dQw4w9WgXcQ" frameborder="0" allowfullscreen></iframe></p>'),
@@ -88,6 +103,10 @@ class MarkdownTest(TestCase):
         self.answer = models.Post.objects.create(title="Test", author=self.owner, content="Test",
                                                  type=models.Post.ANSWER, uid="2")
 
+        # Store the tweet embedded in the test cases.
+        with override_settings(EMBED_FETCHER=f"{__name__}.fetch_stub"):
+            markdown.fetch_embeds(TWEET)
+
         pass
 
     def test_markdown(self):
@@ -111,3 +130,147 @@ class MarkdownTest(TestCase):
 
         # Catch all errors at once.
         self.assertTrue(error_count == 0)
+
+    def test_render_cache(self):
+        "Test that unchanged content is not rendered again"
+        markdown.RENDERED.clear()
+
+        with mock.patch.object(markdown, 'render', wraps=markdown.render) as render:
+            post = models.Post.objects.create(title="Cached", author=self.owner, content="Cached *text*",
+                                              type=models.Post.QUESTION)
+            # Saving other fields keeps the html.
+            post.status = models.Post.CLOSED
+            post.save()
+            self.assertEqual(render.call_count, 1)
+
+            # Other posts with the same text share the rendering.
+            models.Post.objects.create(title="Copy", author=self.owner, content="Cached *text*",
+                                       type=models.Post.QUESTION)
+            self.assertEqual(render.call_count, 1)
+
+            post.content = "Changed *text*"
+            post.save()
+            self.assertEqual(render.call_count, 2)
+            self.assertIn("<em>text</em>", post.html)
+
+    @override_settings(MARKDOWN_CACHE_TABLE=True)
+    def test_render_table(self):
+        "Test that renderings are shared through the database"
+        markdown.parse("Stored *text*")
+
+        # A process with an empty local cache reads the table.
+        local = markdown.RenderCache(size=0)
+        key = markdown.digest("Stored *text*")
+        self.assertIn("<em>text</em>", local.get(key))
+        self.assertTrue(models.Rendered.objects.filter(digest=key).exists())
+
+    def test_batched_links(self):
+        "Test that the links of a text are resolved with one query per kind"
+        links = " ".join(f"{settings.PROTOCOL}://{SITE_URL}/p/{uid}/" for uid in ("1", "2", "3", "4"))
+        text = f"{links} {settings.PROTOCOL}://{SITE_URL}/u/5 @test @nobody"
+
+        with self.assertNumQueries(3):
+            html = markdown.render(text)
+        for post in models.Post.objects.filter(uid__in=["1", "2"]):
+            self.assertIn(f">{post.root.title}</a>", html)
+        self.assertEqual(html.count("Post not found"), 2)
+        self.assertIn(">tested2</a>", html)
+
+    def test_mention_subscription(self):
+        "Test that mentioned users are subscribed to the thread after saving"
+        other = User.objects.create(username="other", email="other@tested.com", password="tested")
+        post = models.Post.objects.create(title="Mention", author=other, content="Hello @test `@other`",
+                                          type=models.Post.QUESTION)
+
+        subs = models.Subscription.objects.filter(post=post)
+        self.assertEqual(set(subs.values_list("user_id", flat=True)), {self.owner.id, other.id})
+        self.assertEqual(markdown.mentions(post.content), [self.owner])
+
+    def test_embed_backfill(self):
+        "Test that embeds are fetched after saving and patched into the post"
+        content = "See https://twitter.com/biostars/status/1234"
+
+        with override_settings(EMBED_FETCHER=f"{__name__}.fetch_error"):
+            post = models.Post.objects.create(title="Tweet", author=self.owner, content=content,
+                                              type=models.Post.QUESTION)
+        post = models.Post.objects.get(pk=post.pk)
+        self.assertIn('href="https://twitter.com/biostars/status/1234"', post.html)
+        self.assertFalse(models.Embed.objects.filter(url=markdown.TWEET_URL % "1234").exists())
+
+        # The next save schedules the fetch again.
+        with override_settings(EMBED_FETCHER=f"{__name__}.fetch_stub"):
+            post.save()
+        self.assertIn(TWEET_HTML, models.Post.objects.get(pk=post.pk).html)
+        self.assertIn(TWEET_HTML, markdown.parse(content, clean=True, escape=False))
+
+        # Once the embeds are stored a save neither parses nor looks them up again.
+        post = models.Post.objects.get(pk=post.pk)
+        with mock.patch.object(markdown, "parse") as parse, mock.patch.object(markdown, "missing_embeds") as missing:
+            post.save()
+        parse.assert_not_called()
+        missing.assert_not_called()
+
+    def test_rerender(self):
+        "Test that stale html is rendered again without saving the posts"
+        from biostar.forum.management.commands import rerender
+
+        models.Post.objects.filter(pk=self.post.pk).update(html="<p>Stale</p>")
+        checkpoint = os.path.join(settings.MEDIA_ROOT, "test.checkpoint")
+
+        # A dry run writes nothing.
+        self.assertEqual(rerender.rerender(size=1, dry=True, checkpoint=checkpoint), 1)
+        self.assertEqual(models.Post.objects.get(pk=self.post.pk).html, "<p>Stale</p>")
+
+        # Resuming after the post skips it.
+        rerender.save_checkpoint(checkpoint, self.post.pk)
+        self.assertEqual(rerender.rerender(size=1, resume=True, checkpoint=checkpoint), 0)
+
+        with mock.patch.object(models.Post, "save") as save:
+            self.assertEqual(rerender.rerender(size=1, checkpoint=checkpoint), 1)
+        save.assert_not_called()
+        self.assertEqual(models.Post.objects.get(pk=self.post.pk).html, markdown.parse("Test", escape=False))
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_slow_render(self):
+        "Test that slow renders are logged with the time of each stage"
+        timings = {}
+        with override_settings(MARKDOWN_SLOW_RENDER=1e-9), self.assertLogs('engine', level='WARNING') as logs:
+            markdown.render("Some *text*", timings=timings)
+
+        self.assertEqual(set(timings), {'resolve', 'mistune', 'clean', 'linkify'})
+        self.assertIn("SLOW: markdown render", logs.output[0])
+
+    def test_markdown_benchmark(self):
+        "Test the markdown benchmark report"
+        from django.core import management
+
+        output = os.path.join(settings.MEDIA_ROOT, "markdownbench.json")
+        management.call_command('markdownbench', size=10, output=output)
+
+        with open(output) as fp:
+            report = json.load(fp)
+        os.remove(output)
+
+        self.assertEqual(report['corpus']['posts'], 10)
+        self.assertEqual(report['stages']['total']['count'], 10)
+        self.assertIn('long_line', report['kinds'])
+        self.assertIn('max_kb', report['allocations']['mistune'])
+
+    def test_render_error(self):
+        "Test that the raw text is kept when rendering fails"
+        with mock.patch.object(markdown, 'render', side_effect=ValueError("broken")):
+            self.assertEqual(markdown.parse("Unrendered *text*"), "Unrendered *text*")
+
+    def test_render_cache_links(self):
+        "Test that cached renderings change with the users and posts they link to"
+        self.assertNotIn("<a", markdown.parse("hello @newbie"))
+
+        user = User.objects.create(username="newbie", email="newbie@tested.com", password="tested")
+        user.profile.handle = "newbie"
+        user.profile.save()
+
+        self.assertIn(f'>{user.profile.name}</a>', markdown.parse("hello @newbie"))
+
+        # Refs resolved for several texts give the same key as the text alone.
+        refs = markdown.resolve("hello @newbie @test")
+        self.assertEqual(markdown.digest("hello @newbie", refs=refs), markdown.digest("hello @newbie"))
@@ -79,6 +79,30 @@ class PostTest(TestCase):
 
         self.moderate(choices=choices, post=comment, extra={'pid': self.post.uid})
 
+    def test_visibility(self):
+        "Test that closing a thread hides its replies"
+        from biostar.forum.management.commands import visibility
+
+        answer = models.Post.objects.create(title="Test", author=self.owner, content="Test",
+                                            type=models.Post.ANSWER, parent=self.post)
+        valid = lambda: set(models.Post.objects.valid_posts(root=self.post).values_list('id', flat=True))
+
+        self.assertEqual(valid(), {self.post.id, answer.id})
+
+        # Closing adds a rationale to the thread.
+        self.moderate(choices=['close'], post=self.post)
+        self.assertEqual(valid(), set())
+
+        self.moderate(choices=['open'], post=self.post)
+        self.assertTrue({self.post.id, answer.id} < valid())
+        self.assertEqual(visibility.check(), 0)
+
+        # The backfill repairs flags that drifted.
+        models.Post.objects.filter(id=answer.id).update(visible=False)
+        self.assertEqual(visibility.check(), 1)
+        visibility.backfill()
+        self.assertEqual(visibility.check(), 0)
+
     def test_merge_profile(self):
         "Test merging two profiles"
 
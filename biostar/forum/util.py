@@ -59,6 +59,13 @@ def datetime_to_unix(date):
     return timegm(date.timetuple())
 
 
+def version_date(version):
+    """
+    Converts a cache version, the time of the change in nanoseconds, to a datetime.
+    """
+    return datetime.fromtimestamp(version / 1e9, tz=utc)
+
+
 def pluralize(value, word):
     if value > 1:
         return "%d %ss" % (value, word)
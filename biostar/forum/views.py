@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import os
 from datetime import timedelta
@@ -10,9 +11,10 @@ from django.contrib.auth.decorators import login_required
 from django.core.cache import cache
 from django.core.paginator import Paginator
 from django.db.models import Count, Q
-from django.http import Http404
+from django.http import Http404, HttpResponse
 from django.shortcuts import render, redirect, reverse
 from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.decorators.http import condition
 from taggit.models import Tag
 from biostar.planet.models import Blog, BlogPost
 from biostar.accounts.models import Profile
@@ -20,6 +22,7 @@ from biostar.forum import forms, auth, tasks, util, search, models, moderate
 from biostar.forum.const import *
 
 from biostar.forum.models import Post, Vote, Badge, Subscription, Log
+from biostar.forum.paging import CachedPaginator, KeysetPaginator
 from biostar.utils.decorators import is_moderator, check_params, reset_count, is_staff, authenticated
 
 User = get_user_model()
@@ -70,38 +73,121 @@ def post_exists(func):
     return _wrapper_
 
 
-class CachedPaginator(Paginator):
+def is_anonymous(request):
     """
-    Paginator that caches the count call.
+    Visitors without a session are anonymous and have no pending messages, checked without a query.
     """
+    anonymous = settings.SESSION_COOKIE_NAME not in request.COOKIES and 'messages' not in request.COOKIES
+    return request.method in ("GET", "HEAD") and anonymous and not request.user.is_authenticated
 
-    # Time to live for the cache, in seconds
-    TTL = 300
 
-    def __init__(self, cache_key='', ttl=None, *args, **kwargs):
-        self.cache_key = cache_key
+def anon_cache(version, on_hit=None):
+    """
+    Serves the pages of anonymous visitors from the cache while version(**kwargs) stays the same.
+
+    Pages are keyed by path and query string, the timeout only bounds what a missed change may show.
+    on_hit(request, data) runs for pages served from the cache with the data the view stored on the response.
+    """
+
+    def outer(func):
+        @wraps(func)
+        def inner(request, **kwargs):
+            if not is_anonymous(request):
+                return func(request, **kwargs)
+
+            digest = hashlib.md5(request.get_full_path().encode()).hexdigest()
+            cache_key = f"{PAGE_CACHE_KEY}-{digest}-{version(**kwargs)}"
+
+            entry = cache.get(cache_key)
+            if entry is not None:
+                if on_hit:
+                    on_hit(request, entry['data'])
+                return HttpResponse(entry['content'], content_type=entry['content_type'])
+
+            response = func(request, **kwargs)
+
+            # Only complete pages are stored, errors and redirects are not.
+            if response.status_code == 200 and not response.streaming:
+                entry = dict(content=response.content, content_type=response['Content-Type'],
+                             data=getattr(response, 'cache_data', {}))
+                cache.set(cache_key, entry, settings.PAGE_CACHE_TIMEOUT)
+
+            return response
+
+        return inner
+
+    return outer
+
+
+def listing_version(tag='', topic=LATEST):
+    """
+    Only the threads shown in a tag or topic listing change its version.
+    """
+    # Open posts are the questions without answers.
+    topic = topic.lower()
+    post_type = Post.QUESTION if topic == OPEN else POST_TYPE.get(topic)
+
+    return models.listing_version(tag=tag, post_type=post_type)
+
 
-        # May not contain spaces
-        self.cache_key = ''.join(self.cache_key.split())
+def thread_state(request, uid):
+    """
+    Returns the version and the last edit date of the thread of the post, None when there is no post.
+
+    Answers and comments resolve to their root, only the root version moves.
+    The root is cached until the thread version changes and is looked up once per request.
+    """
+    if hasattr(request, 'thread_state'):
+        return request.thread_state
+
+    cache_key = f"{THREAD_STATE_KEY}-{uid}"
+    cached = cache.get(cache_key)
+    if cached:
+        root_uid, version, lastedit_date = cached
+        if models.thread_version(root_uid) == version:
+            request.thread_state = version, lastedit_date
+            return request.thread_state
+
+    root = Post.objects.filter(uid=uid).values_list('root__uid', 'root__lastedit_date').first()
+    if root and root[0]:
+        version = models.thread_version(root[0])
+        cache.set(cache_key, (root[0], version, root[1]), settings.THREAD_CACHE_TIMEOUT)
+        request.thread_state = version, root[1]
+    else:
+        request.thread_state = None
+
+    return request.thread_state
+
+
+def thread_etag(request, uid):
+    """
+    The thread version and edit date identify the page seen by anonymous visitors, users get a fresh page.
+    """
+    state = thread_state(request, uid) if is_anonymous(request) else None
+    if not state:
+        return None
 
-        self.ttl = self.TTL
+    version, lastedit_date = state
+    return f"{version}-{lastedit_date.timestamp()}"
 
-        super(CachedPaginator, self).__init__(*args, **kwargs)
 
-    @property
-    def count(self):
+def thread_modified(request, uid):
+    """
+    The latest of the root edit date and the time of the last change to the thread.
+    """
+    state = thread_state(request, uid) if is_anonymous(request) else None
+    if not state:
+        return None
 
-        if self.cache_key:
-            # See if it is access the cache
-            value = cache.get(self.cache_key)
-            if value is None:
-                value = super(CachedPaginator, self).count
-                # logger.debug(f'setting the cache for "{self.cache_key}"')
-                cache.set(self.cache_key, value, self.ttl)
-        else:
-            value = super(CachedPaginator, self).count
+    version, lastedit_date = state
+    return max(util.version_date(version), lastedit_date)
 
-        return value
+
+def count_view(request, data):
+    """
+    Counts the view of a post served from the page cache.
+    """
+    models.update_post_views(post=Post(id=data['post_id']), request=request, timeout=settings.POST_VIEW_TIMEOUT)
 
 
 def apply_sort(posts, limit=None, order=None):
@@ -118,8 +204,8 @@ def apply_sort(posts, limit=None, order=None):
         delta = util.now() - timedelta(days=days)
         posts = posts.filter(lastedit_date__gt=delta)
 
-    # Select related information used during rendering.
-    posts = posts.select_related("root").select_related("author__profile", "lastedit_user__profile")
+    # Select only the related information used during rendering.
+    posts = models.post_listing(posts)
 
     return posts
 
@@ -266,6 +352,7 @@ def release_quar(request, uid):
         post.author.profile.bump_over_threshold()
 
     Post.objects.filter(uid=uid).update(spam=Post.NOT_SPAM)
+    models.update_visibility(post)
 
     return redirect('/')
 
@@ -277,6 +364,7 @@ def post_list(request, topic=None, tag="", cutoff=None, ordering=None):
 
     # Parse the GET parameters for filtering information
     page = request.GET.get('page', 1)
+    cursor = request.GET.get('cursor', '')
     order = request.GET.get("order", ordering) or 'rank'
     topic = topic or request.GET.get("type", LATEST) or LATEST
     limit = request.GET.get("limit", "all") or "all"
@@ -293,21 +381,25 @@ def post_list(request, topic=None, tag="", cutoff=None, ordering=None):
 
     posts = apply_sort(posts, limit=limit, order=order)
 
-    # Institute a cutoff
+    # Institute a cutoff, the listing is short enough to page by offset.
     if cutoff:
         posts = posts[:cutoff]
+        paginator = CachedPaginator(cache_key=cache_key, object_list=posts, per_page=settings.POSTS_PER_PAGE)
+        return paginator.get_page(page)
 
-    # Filter for any empty strings
-    paginator = CachedPaginator(cache_key=cache_key, object_list=posts, per_page=settings.POSTS_PER_PAGE)
+    # Seek to the cursor on the sort order and the post id.
+    paginator = KeysetPaginator(cache_key=cache_key, object_list=posts, per_page=settings.POSTS_PER_PAGE,
+                                order=ORDER_MAPPER.get(order) or '-rank')
 
     # Apply the post paging.
-    posts = paginator.get_page(page)
+    posts = paginator.get_page(page, cursor=cursor)
 
     return posts
 
 
 @check_params(allowed=ALLOWED_PARAMS)
 @ensure_csrf_cookie
+@anon_cache(version=listing_version)
 def latest(request):
     """
     Show latest post listing.
@@ -322,6 +414,7 @@ def latest(request):
 
 @check_params(allowed=ALLOWED_PARAMS)
 @ensure_csrf_cookie
+@anon_cache(version=listing_version)
 def post_tags(request, tag):
     """
     Show list of posts belonging to one post.
@@ -336,6 +429,7 @@ def post_tags(request, tag):
 
 @check_params(allowed=ALLOWED_PARAMS)
 @ensure_csrf_cookie
+@anon_cache(version=listing_version)
 def post_topic(request, topic):
     """
     Show list of posts of a given type
@@ -515,6 +609,8 @@ def badge_view(request, uid):
 
 @check_params(allowed=ALLOWED_PARAMS)
 @ensure_csrf_cookie
+@condition(etag_func=thread_etag, last_modified_func=thread_modified)
+@anon_cache(version=models.thread_version, on_hit=count_view)
 def post_view(request, uid):
     "Return a detailed view for specific post"
 
@@ -552,7 +648,12 @@ def post_view(request, uid):
 
     context = dict(post=root, tree=comment_tree, form=form, answers=answers)
 
-    return render(request, "post_view.html", context=context)
+    response = render(request, "post_view.html", context=context)
+
+    # Views of the cached page are counted on this post.
+    response.cache_data = dict(post_id=post.id)
+
+    return response
 
 
 @check_params(allowed=CREATE_PARAMS)
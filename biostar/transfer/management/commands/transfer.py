@@ -13,7 +13,7 @@ from taggit.models import Tag
 
 from biostar.accounts.models import User, Profile
 from biostar.forum import util, markdown
-from biostar.forum.models import Post, Vote, Subscription, Badge, Award
+from biostar.forum.models import Post, Vote, Subscription, Badge, Award, set_visible
 from biostar.transfer.models import UsersUser, PostsPost, PostsVote, PostsSubscription, BadgesAward, UsersProfile
 
 logger = logging.getLogger("engine")
@@ -292,6 +292,9 @@ def bulk_copy_posts(limit):
     Post.objects.bulk_update(objs=gen_updates(), fields=["root", "parent"],
                              batch_size=1000)
 
+    # Bulk created posts skip the signals that set the visible flag.
+    set_visible(Post.objects.all())
+
     Post.objects.bulk_update(objs=set_counts(), fields=["reply_count", "comment_count", "answer_count"],
                              batch_size=1000)
     elapsed(f"Set {pcount} post counts.")
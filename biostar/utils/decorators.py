@@ -435,8 +435,8 @@ def task(f):
     return WORKER(f)
 
 
-def timer(f):
+def timer(secs, **kwargs):
     """
     Utility function to access timer decorator.
     """
-    return TIMER(f)
+    return TIMER(secs, **kwargs)